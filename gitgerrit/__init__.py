@@ -1,10 +1,23 @@
 __all__ = ["main", "__version__"]
 
+import sys
 from ._version import get_versions
-from .gitgerrit import main
 
 __version__ = get_versions()["version"]
 del get_versions
 
 
+def main():
+    """Forwards the invocation to a running git-gerrit daemon or, if there is none, executes it in-process"""
+    from .daemon import forward
+
+    exit_code = forward(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+    from .gitgerrit import main as run_in_process
+
+    run_in_process()
+
+
 __all__ = ["main", "__version__"]
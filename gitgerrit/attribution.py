@@ -0,0 +1,104 @@
+"""Routing review comments of a whole commit chain to the changes that introduced the commented lines.
+
+Analysis tools comment the files of the chain top. Every comment is moved to the local commit that last touched the
+commented line according to git blame over the chain, with its line numbers translated to that commit's version of
+the file. Lines no commit of the chain touched go to the newest commit modifying the file, whose version of the file
+is the one that was analysed. Files no commit of the chain modifies cannot be commented and are dropped.
+"""
+import subprocess
+from .logger import LOGGER
+from .remap import unquote_path
+
+
+def _git(working_tree, *arguments):
+    # paths with non-ASCII characters are not quoted, only the ones with quotes, backslashes or control characters
+    command = ["git", "-c", "core.quotePath=false"] + list(arguments)
+    process = subprocess.run(command, cwd=working_tree, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError(f"git {arguments[0]} failed: {process.stderr.decode('utf-8', 'replace').strip()}")
+    return process.stdout.decode("utf-8", "replace")
+
+
+def chain_commits(working_tree, top, changeids):
+    """Returns [(commit, Change-Id)] of the local commits, newest first, from top down to the first commit that is
+    not part of the chain"""
+    wanted = set(changeids)
+    output = _git(
+        working_tree, "log", "-n", str(len(wanted)), "--format=%x00%H%x00%(trailers:key=Change-Id,valueonly)", top, "--"
+    )
+    records = output.split("\0")[1:]
+    commits = []
+    for commit, trailers in zip(records[0::2], records[1::2]):
+        values = [value.strip() for value in trailers.splitlines() if value.strip()]
+        if not values or values[-1] not in wanted:
+            break
+        commits.append((commit, values[-1]))
+    return commits
+
+
+def modified_files(working_tree, commits):
+    """Returns {commit: set of paths it modifies} with a single git log"""
+    output = _git(working_tree, "log", "--no-walk=unsorted", "--format=%x00%H", "--name-only", "--no-renames", *commits, "--")
+    files = {}
+    for record in output.split("\0")[1:]:
+        commit, _, names = record.partition("\n")
+        files[commit] = {unquote_path(name) for name in names.splitlines() if name}
+    return files
+
+
+def blame(working_tree, base, top, path):
+    """Returns {line at top: (commit, line in commit)} for lines of path commits of base..top introduced"""
+    revisions = f"{base}..{top}" if base else top
+    lines = {}
+    commit = None
+    boundaries = set()
+    for line in _git(working_tree, "blame", "--porcelain", revisions, "--", path).splitlines():
+        if line.startswith("\t"):
+            continue
+        parts = line.split(" ")
+        if len(parts[0]) == 40 and len(parts) >= 3 and parts[1].isdigit():
+            commit = parts[0]
+            lines[int(parts[2])] = (commit, int(parts[1]))
+        elif line == "boundary":
+            boundaries.add(commit)
+    return {line: origin for line, origin in lines.items() if origin[0] not in boundaries}
+
+
+def _remapped(comment, origins, commit):
+    """Copy of the comment with lines translated into the version of the file in commit"""
+    line = origins[comment.end_line][1]
+    if comment.range:
+        start = origins.get(comment.range[0])
+        if start and start[0] == commit:
+            return comment.moved(line, (start[1], comment.range[1], line, comment.range[3]))
+        # range spans lines of several changes, keep only the line it ends on
+    return comment.moved(line, None)
+
+
+def route_comments(working_tree, commits, comments):
+    """Splits RobotComments ({path: [comment]}, lines of the chain top) between commits ([(commit, Change-Id)],
+    newest first) and returns {commit: {path: [comment]}}"""
+    files = modified_files(working_tree, [commit for commit, _ in commits])
+    chain = {commit for commit, _ in commits}
+    try:
+        parent = _git(working_tree, "rev-parse", "--verify", "--quiet", f"{commits[-1][0]}^").strip()
+    except RuntimeError:
+        parent = None  # chain starts from the root commit
+    routed = {}
+    dropped = 0
+    for path, path_comments in comments.items():
+        touching = [commit for commit, _ in commits if path in files.get(commit, ())]
+        if not touching:
+            dropped += len(path_comments)
+            LOGGER.warning(f"{path} is not modified by the chain, dropping its {len(path_comments)} comment(s)")
+            continue
+        origins = blame(working_tree, parent, commits[0][0], path) if len(touching) > 1 else {}
+        for comment in path_comments:
+            origin = origins.get(comment.end_line)
+            if origin and origin[0] in chain:
+                routed.setdefault(origin[0], {}).setdefault(path, []).append(_remapped(comment, origins, origin[0]))
+            else:
+                routed.setdefault(touching[0], {}).setdefault(path, []).append(comment)
+    if dropped:
+        LOGGER.warning(f"{dropped} comment(s) dropped")
+    return routed
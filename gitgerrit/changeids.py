@@ -0,0 +1,126 @@
+"""Persistent mapping of Change-Ids to project~number identifiers.
+
+Gerrit has to search its secondary index to resolve a bare Change-Id or a project~branch~Change-Id triplet on every
+request, while project~number is a direct lookup. Identifiers are learned from ChangeInfos the client receives anyway
+(queries, change details) and kept in a per host file under the user cache directory, so later invocations use the
+cheap form from their first request on.
+
+Triplets always name a single change. A bare Change-Id is shared by cherry-picks of the change on other branches, so
+it is mapped only from complete results of queries searching nothing but Change-Ids, which include every change
+with the Change-Id. Change-Ids of several changes are mapped to AMBIGUOUS and left for gerrit to resolve (or reject).
+"""
+import json
+import os
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+from urllib.parse import quote, urlsplit, parse_qs
+from .logger import LOGGER
+
+MAX_IDS = 10000
+# Same Change-Id on several branches cannot be mapped to a single change
+AMBIGUOUS = ""
+RE_CHANGEID_TERM = re.compile(r"^change:(I[0-9a-f]{40})$")
+
+
+def cache_dir():
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "git-gerrit"
+
+
+class ChangeIds:
+    """Thread safe Change-Id to project~number mapping, loaded lazily and saved by save()"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._ids = None
+        self._changed = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_host(cls, host):
+        # earlier versions mapped bare Change-Ids of any response, their files are not trusted
+        return cls(cache_dir() / f"{quote(host, safe='')}.ids.v2.json")
+
+    def _load(self):
+        if self._ids is None:
+            try:
+                self._ids = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                self._ids = {}
+        return self._ids
+
+    def get(self, change):
+        with self._lock:
+            return self._load().get(change) or None
+
+    def learn(self, decoded, endpoint):
+        """Records identifiers of every ChangeInfo found in decoded response of endpoint"""
+        if isinstance(decoded, dict):
+            items = [decoded]
+        elif isinstance(decoded, list):
+            items = [item for item in decoded if isinstance(item, dict)]
+        else:
+            return
+        searched = _searched_changeids(endpoint, items)
+        counts = Counter(item.get("change_id") for item in items)
+        with self._lock:
+            ids = self._load()
+            for item in items:
+                if not item.get("_number") or "project" not in item or "id" not in item:
+                    continue
+                qualified = f"{quote(item['project'], safe='')}~{item['_number']}"
+                self._set(ids, item["id"], qualified)
+                if item.get("change_id") in searched:
+                    self._set(ids, item["change_id"], qualified if counts[item["change_id"]] == 1 else AMBIGUOUS)
+
+    def _set(self, ids, change, qualified):
+        if ids.get(change) != qualified:
+            ids[change] = qualified
+            self._changed[change] = qualified
+
+    def evict(self, change):
+        with self._lock:
+            if self._load().pop(change, None) is not None:
+                self._changed[change] = None
+
+    def save(self):
+        """Merges changes of this process into the file, keeping the file under MAX_IDS entries"""
+        with self._lock:
+            if not self._changed:
+                return
+            try:
+                ids = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                ids = {}
+            for change, qualified in self._changed.items():
+                ids.pop(change, None)
+                if qualified is not None:
+                    ids[change] = qualified
+            # oldest entries are first as updated entries are always moved to the end
+            ids = dict(list(ids.items())[-MAX_IDS:])
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                temporary = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+                temporary.write_text(json.dumps(ids))
+                os.replace(temporary, self.path)
+            except OSError as error:
+                LOGGER.debug(f"Could not save change identifiers into {self.path}: {error}")
+                return
+            self._ids = ids
+            self._changed = {}
+
+
+def _searched_changeids(endpoint, items):
+    """Change-Ids every change of which is in items: searched by a query of only Change-Ids, with all results on the
+    first page"""
+    url = urlsplit(endpoint)
+    if not url.path.rstrip("/").endswith("changes") or (items and items[-1].get("_more_changes")):
+        return set()
+    parameters = parse_qs(url.query)
+    if parameters.get("S", ["0"]) != ["0"] or len(parameters.get("q", [])) != 1:
+        return set()
+    terms = [RE_CHANGEID_TERM.match(term) for term in parameters["q"][0].split(" OR ")]
+    if not all(terms):
+        return set()
+    return {term.group(1) for term in terms}
@@ -0,0 +1,312 @@
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pygerrit2 import GerritRestAPI
+from requests.adapters import HTTPAdapter
+from . import codec
+from .logger import LOGGER, log_event
+
+RE_ENDPOINT_CHANGE = re.compile(r"^/?changes/(?P<change>[^/?]+)")
+# Endpoints of a change that tell about other changes too
+RE_MULTI_CHANGE_ENDPOINT = re.compile(r"/(related|submitted_together)\b")
+# ChangeInfo fields that Gerrit only returns when asked with "o=" option. Everything else, like topic, hashtags,
+# status or project, is part of every ChangeInfo and needs no options at all.
+FIELD_OPTIONS = {
+    "labels": "LABELS",
+    "votes": "DETAILED_LABELS",
+    "voters": "DETAILED_ACCOUNTS",
+    "current_revision": "CURRENT_REVISION",
+    "revision_number": "CURRENT_REVISION",
+    "commit": "CURRENT_COMMIT",
+    "web_links": "WEB_LINKS",
+    "submittable": "SUBMITTABLE",
+}
+# Too Many Requests from rate limiting and Service Unavailable from QoS plugin both ask us to come back later
+THROTTLE_STATUSES = (429, 503)
+MAX_THROTTLE_RETRIES = 5
+MAX_RETRY_AFTER = 300
+DEFAULT_BACKOFF = 1
+DEFAULT_BURST = 10
+ADAPTIVE_START_RATE = 10
+MIN_RATE = 0.1
+RECOVERY_SUCCESSES = 20
+RECOVERY_FACTOR = 1.25
+# Latencies of this many latest requests are kept for progress reporting
+LATENCY_SAMPLES = 200
+# In-memory cache drops expired responses, and then the oldest ones, when it grows over this many responses
+MAX_CACHED_RESPONSES = 1000
+
+
+def options_for_fields(fields):
+    """Returns smallest list of "o=" options that makes Gerrit include given ChangeInfo fields"""
+    return sorted({FIELD_OPTIONS[field] for field in fields or [] if field in FIELD_OPTIONS})
+
+
+class GerritClient(GerritRestAPI):
+    """GerritRestAPI that decodes and encodes json with the fastest available codec and reports every request as a
+    structured log event
+
+    When cache_ttl is set, GET responses are kept in memory for that many seconds, up to MAX_CACHED_RESPONSES of
+    them. Any write request drops the whole cache as it can change the state of the change and of its relations.
+
+    Requests are paced by a token bucket (rate_limit requests per second, unlimited by default). Requests
+    throttled by the server are retried after Retry-After and the bucket slows down. Total time spent waiting
+    is available in throttled_seconds, number of requests sent over the wire in requests_sent and durations of the
+    latest requests in latencies.
+
+    With shared_cache (ResponseCache), GET responses are also looked up from and stored into a cache shared with
+    other processes, after the in-memory cache. Writes invalidate responses about the change in both. Polling
+    bypasses both caches with get(..., cached=False).
+
+    With change_ids, endpoints of changes are rewritten to use project~number identifiers learned from earlier
+    responses. If gerrit does not find the change with the learned identifier, it is forgotten and the request is
+    sent again with the original one.
+    """
+
+    def __init__(
+        self, url, auth=None, verify=True, cache_ttl=0, rate_limit=None, burst=DEFAULT_BURST, change_ids=None, shared_cache=None
+    ):
+        super().__init__(url, auth=auth, verify=verify)
+        self.cache_ttl = cache_ttl
+        self.change_ids = change_ids
+        self.shared_cache = shared_cache
+        self._cache = {}
+        self.bucket = TokenBucket(rate_limit, burst)
+        self.throttled_seconds = 0
+        self.requests_sent = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+        self.session.headers["Accept-Encoding"] = "gzip"
+
+    def resize_pool(self, connections):
+        """Keeps up to given number of connections alive, so that as many threads can send requests in parallel"""
+        adapter = HTTPAdapter(pool_maxsize=connections)
+        for prefix in ("https://", "http://"):
+            self.session.mount(prefix, adapter)
+
+    def make_url(self, endpoint):
+        """Full url of the endpoint, always asking for compact (not pretty printed) json"""
+        url = super().make_url(endpoint)
+        return url + ("&" if "?" in url else "?") + "pp=0"
+
+    def get(self, endpoint, return_response=False, cached=True, **kwargs):
+        """GET response of endpoint, from the caches unless cached is False, like when polling for changes"""
+        if not cached or (not self.cache_ttl and not self.shared_cache) or return_response or kwargs:
+            return self._request("get", endpoint, return_response, **kwargs)
+
+        cached = self._cache.get(endpoint)
+        if cached and cached[0] > time.monotonic():
+            log_event(f"GET {endpoint} -> cached", method="GET", endpoint=endpoint, status="cached")
+            return cached[1]
+        result = self.shared_cache.get(endpoint) if self.shared_cache else None
+        if result is not None:
+            log_event(f"GET {endpoint} -> shared cache", method="GET", endpoint=endpoint, status="cached")
+        else:
+            result = self._request("get", endpoint, return_response)
+            if self.shared_cache:
+                self.shared_cache.put(endpoint, self._cache_key(endpoint), result)
+        if self.cache_ttl:
+            self._remember(endpoint, result)
+        return result
+
+    def _remember(self, endpoint, result):
+        now = time.monotonic()
+        with self._lock:
+            self._cache.pop(endpoint, None)  # keep insertion order the order of expiry
+            self._cache[endpoint] = (now + self.cache_ttl, result)
+            if len(self._cache) <= MAX_CACHED_RESPONSES:
+                return
+            for key, (expires, _) in list(self._cache.items()):
+                if expires > now and len(self._cache) <= MAX_CACHED_RESPONSES:
+                    break
+                del self._cache[key]
+
+    def _cache_key(self, endpoint):
+        """Change the response of endpoint is about, None for responses about several changes"""
+        change = RE_ENDPOINT_CHANGE.match(endpoint)
+        if not change or RE_MULTI_CHANGE_ENDPOINT.search(endpoint):
+            return None
+        change = change.group("change")
+        return (self.change_ids.get(change) if self.change_ids else None) or change
+
+    def put(self, endpoint, return_response=False, **kwargs):
+        return self._request("put", endpoint, return_response, **kwargs)
+
+    def post(self, endpoint, return_response=False, **kwargs):
+        return self._request("post", endpoint, return_response, **kwargs)
+
+    def delete(self, endpoint, return_response=False, **kwargs):
+        return self._request("delete", endpoint, return_response, **kwargs)
+
+    def _request(self, method, endpoint, return_response, **kwargs):
+        if method != "get":
+            self._cache.clear()
+        if isinstance(kwargs.get("data"), (dict, list)):
+            kwargs["data"] = codec.dumps(kwargs["data"])
+            kwargs["headers"] = dict(kwargs.get("headers", {}), **{"Content-Type": "application/json;charset=UTF-8"})
+        request_kwargs = self.translate_kwargs(**kwargs)
+
+        change = RE_ENDPOINT_CHANGE.match(endpoint)
+        qualified = self.change_ids.get(change.group("change")) if self.change_ids and change else None
+        if qualified:
+            qualified_endpoint = endpoint[: change.start("change")] + qualified + endpoint[change.end("change") :]
+            response = self._send_with_retries(method, qualified_endpoint, request_kwargs)
+            if response.status_code == 404:
+                # change was deleted or moved to another project, let gerrit resolve the original identifier
+                self.change_ids.evict(change.group("change"))
+                response = self._send_with_retries(method, endpoint, request_kwargs)
+        else:
+            response = self._send_with_retries(method, endpoint, request_kwargs)
+        if method != "get" and self.shared_cache:
+            # after the write, so that other processes cannot cache the old state in between
+            self.shared_cache.invalidate([change.group("change") if change else None, self._cache_key(endpoint)])
+
+        decoded = _decode_response(response)
+        self.bucket.succeeded()
+        if self.change_ids:
+            self.change_ids.learn(decoded, endpoint)
+        if return_response:
+            return decoded, response
+        return decoded
+
+    def _send_with_retries(self, method, endpoint, request_kwargs):
+        """Sends the request, retrying as long as server throttles it"""
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            self._wait(self.bucket.acquire())
+            response = self._send(method, endpoint, request_kwargs)
+            if response.status_code not in THROTTLE_STATUSES or attempt == MAX_THROTTLE_RETRIES:
+                break
+            delay = _retry_after(response, attempt)
+            self.bucket.slow_down()
+            LOGGER.debug(f"Server responded {response.status_code}, retrying in {delay:.1f}s at {self.bucket.describe()}")
+            self._wait(delay)
+        return response
+
+    def _wait(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+            with self._lock:
+                self.throttled_seconds += seconds
+
+    def _send(self, method, endpoint, request_kwargs):
+        with self._lock:
+            self.requests_sent += 1
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method.upper(), self.make_url(endpoint), **request_kwargs)
+            status = response.status_code
+            return response
+        finally:
+            duration = time.perf_counter() - started
+            self.latencies.append(duration)
+            duration = round(duration, 4)
+            change = RE_ENDPOINT_CHANGE.match(endpoint)
+            log_event(
+                f"{method.upper()} {endpoint} -> {status} ({duration}s)",
+                method=method.upper(),
+                endpoint=endpoint,
+                change=change.group("change") if change else None,
+                status=status,
+                duration=duration,
+            )
+
+
+class TokenBucket:
+    """Thread safe token bucket limiting requests to rate per second with bursts of up to burst requests.
+
+    Rate None means unlimited. Rate is halved every time server throttles and grows back slowly on successful
+    requests, up to max_rate. When max_rate is None, bucket becomes unlimited again once fully recovered.
+    """
+
+    def __init__(self, rate=None, burst=DEFAULT_BURST):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def describe(self):
+        return f"{self.rate:.2f} requests/s" if self.rate else "unlimited rate"
+
+    def acquire(self):
+        """Takes a token and returns number of seconds caller has to wait before using it"""
+        with self._lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            # tokens go negative when there are waiters, each of them waits for their own turn
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def slow_down(self):
+        with self._lock:
+            self.rate = self.rate / 2 if self.rate else ADAPTIVE_START_RATE
+            self.rate = max(self.rate, MIN_RATE)
+            self._successes = 0
+
+    def succeeded(self):
+        with self._lock:
+            if not self.rate or self.rate == self.max_rate:
+                return
+            self._successes += 1
+            if self._successes < RECOVERY_SUCCESSES:
+                return
+            self._successes = 0
+            self.rate *= RECOVERY_FACTOR
+            if self.max_rate is None and self.rate >= ADAPTIVE_START_RATE:
+                self.rate = None
+            elif self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+
+def http_error(error, change):
+    """Translates HTTPError of a request concerning change into RuntimeError with a meaningful message"""
+    status = error.response.status_code
+    if status == 404:
+        message = f"Provided change ({change}) cannot be found on remote gerrit server."
+    elif status in (401, 403):
+        message = f"Not allowed to access change ({change}), check gerrit user and token in your configuration."
+    elif status in (429, 503):
+        message = f"Gerrit server kept throttling requests for change ({change}), try again later or lower gerrit.rateLimit."
+    else:
+        message = f"Request for change ({change}) failed with HTTP {status}: {error.response.text.strip()}"
+    return RuntimeError(message)
+
+
+def _retry_after(response, attempt):
+    """Seconds to wait before retrying as told by Retry-After header, exponential backoff if there is none"""
+    value = response.headers.get("Retry-After", "").strip()
+    delay = None
+    if value.isdigit():
+        delay = int(value)
+    elif value:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            delay = None
+    if delay is None:
+        delay = DEFAULT_BACKOFF * 2 ** attempt
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+
+def _decode_response(response):
+    """Decodes json response with codec, other content is returned as text like pygerrit2 does"""
+    response.raise_for_status()
+    content = response.content
+    if not content.strip():
+        return ""
+    if response.headers.get("content-type", "").split(";")[0] != "application/json":
+        return response.text.strip()
+    try:
+        return codec.loads_gerrit(content)
+    except ValueError:
+        LOGGER.error(f"Invalid json content: {content[:200]!r}")
+        raise
@@ -0,0 +1,59 @@
+"""Json encoding and decoding with the fastest library available.
+
+orjson is preferred, then simdjson (decoding only) and finally standard library json.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+GERRIT_MAGIC_JSON_PREFIX = b")]}'\n"
+
+if orjson is not None:
+    DECODER = "orjson"
+elif simdjson is not None:
+    DECODER = "simdjson"
+else:
+    DECODER = "json"
+ENCODER = "orjson" if orjson is not None else "json"
+
+
+def loads(data):
+    """Decodes json from bytes, bytearray or memoryview"""
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if simdjson is not None:
+        return simdjson.loads(data)
+    return json.loads(data)
+
+
+def json_default(obj):
+    """Encodes objects that have to_json(), like RobotComments, as the json value it returns"""
+    if hasattr(obj, "to_json"):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj, sort_keys=False):
+    """Encodes obj into utf-8 json bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(
+        obj, sort_keys=sort_keys, ensure_ascii=False, separators=(",", ":"), default=json_default
+    ).encode("utf-8")
+
+
+def loads_gerrit(content):
+    """Decodes Gerrit json response body, skipping the XSSI protection prefix without copying the body"""
+    if content.startswith(GERRIT_MAGIC_JSON_PREFIX):
+        return loads(memoryview(content)[len(GERRIT_MAGIC_JSON_PREFIX) :])
+    return loads(content)
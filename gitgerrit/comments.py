@@ -0,0 +1,119 @@
+"""Compact model of review payload comments.
+
+Analysis payloads can have millions of comments. A dict per comment costs several times the memory of an object
+with __slots__, so comments are converted into RobotComments while the payload is being decoded, before the dicts of
+all comments would exist at the same time, with robot ids interned as the same values repeat all over large payloads.
+Comments are turned back into json only while the request body is encoded (see codec.json_default).
+
+The decoder only tells objects apart by their keys, so anything with a message, like properties of a comment, is
+converted too. That conversion is lossless, objects outside of the comment lists are turned back into dicts once the
+payload has been decoded, and only then the comments of the lists are passed to convert.
+"""
+import json
+import sys
+
+# Comment fields kept in slots, anything else (like fix_suggestions or properties) is kept as it is in extra
+FIELDS = ("line", "range", "message", "robot_id", "robot_run_id")
+RANGE_FIELDS = ("start_line", "start_character", "end_line", "end_character")
+# ReviewInput fields, objects with message and none of these are comments
+REVIEW_INPUT_KEYS = {"comments", "robot_comments", "labels", "tag", "notify", "drafts", "reviewers", "ready", "work_in_progress"}
+
+
+class RobotComment:
+    """Robot comment of one line, range (start_line, start_character, end_line, end_character) or whole file"""
+
+    __slots__ = FIELDS + ("extra",)
+
+    def __init__(self, line, range, message, robot_id, robot_run_id, extra=None):
+        self.line = line
+        self.range = range
+        self.message = message
+        self.robot_id = robot_id
+        self.robot_run_id = robot_run_id
+        self.extra = extra
+
+    @classmethod
+    def from_json(cls, item):
+        """Converts comment dict of review input, consuming the dict"""
+        line = item.pop("line", None)
+        comment_range = item.pop("range", None)
+        if isinstance(comment_range, dict):
+            get = comment_range.get
+            comment_range = (get("start_line", 0), get("start_character", 0), get("end_line", 0), get("end_character", 0))
+        elif comment_range is not None:
+            item["range"] = comment_range  # not a range of a comment, keep it as it is
+            comment_range = None
+        message = item.pop("message", "")
+        robot_id = _intern(item.pop("robot_id", None))
+        return cls(line, comment_range, message, robot_id, item.pop("robot_run_id", None), item or None)
+
+    def to_json(self):
+        item = dict(self.extra or {})
+        if self.line is not None:
+            item["line"] = self.line
+        if self.range is not None:
+            item["range"] = dict(zip(RANGE_FIELDS, self.range))
+        item["message"] = self.message
+        for field in ("robot_id", "robot_run_id"):
+            if getattr(self, field) is not None:
+                item[field] = getattr(self, field)
+        return item
+
+    def key(self):
+        """Comments with same key are duplicates"""
+        return self.line, self.range, self.message
+
+    def moved(self, line, comment_range):
+        """Copy of the comment attached to other line and range"""
+        return RobotComment(line, comment_range, self.message, self.robot_id, self.robot_run_id, self.extra)
+
+    @property
+    def end_line(self):
+        """Line the comment is attached to, None for file comments"""
+        return self.range[2] if self.range else self.line
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _plain(value):
+    """value with RobotComments in it turned back into dicts"""
+    if isinstance(value, RobotComment):
+        value = value.to_json()
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    return value
+
+
+def load_review_input(text, convert):
+    """Decodes review input json, with every comment of comments ({path: [comment]}) replaced with what convert
+    returns for its RobotComment. Decoding object by object is slower than codec.loads, but peak memory is a fraction"""
+
+    def hook(item):
+        if "message" in item and not REVIEW_INPUT_KEYS.intersection(item):
+            comment = RobotComment.from_json(item)
+            if comment.extra:
+                comment.extra = _plain(comment.extra)  # objects in a comment are not comments
+            return comment
+        return item
+
+    review_input = json.loads(text, object_hook=hook)
+    if not isinstance(review_input, dict):
+        return _plain(review_input)
+    for key, value in review_input.items():
+        if key != "comments":
+            review_input[key] = _plain(value)
+        elif isinstance(value, dict):
+            for path, comments in value.items():
+                if not isinstance(comments, list):
+                    value[path] = _plain(comments)
+                    continue
+                for idx, comment in enumerate(comments):
+                    if isinstance(comment, dict):
+                        comment = RobotComment.from_json(comment)  # comment without message
+                    if isinstance(comment, RobotComment):
+                        comments[idx] = convert(comment)
+    return review_input
@@ -0,0 +1,118 @@
+"""Reading gerrit section of git configuration.
+
+Configuration files are parsed directly instead of going through GitPython config_reader(), which parses every file
+completely on every run, or `git config`, which refuses documented keys with underscores like
+gerrit.prevent_build_topic. Result is memoized on modification times of the configuration files, so repeated reads
+(batch, daemon) cost only a few stat calls and still notice configuration changes.
+"""
+import os
+import re
+from pathlib import Path
+from .logger import LOGGER
+
+RE_SECTION = re.compile(r'^\[\s*(?P<section>[^\]\s"]+)(?:\s+"(?P<subsection>(?:[^"\\]|\\.)*)")?\s*\]\s*(?P<rest>.*)$')
+ESCAPES = {"n": "\n", "t": "\t", "b": "\b"}
+MAX_INCLUDE_DEPTH = 10
+_SECTIONS = {}
+
+
+def _config_files(git_dir=None):
+    """Configuration files git reads for the repository in order of precedence, whether they exist or not. Without
+    git_dir, outside of a repository, only system, XDG and global files"""
+    home = Path(os.environ.get("HOME", "~")).expanduser()
+    xdg_config = Path(os.environ.get("XDG_CONFIG_HOME") or home / ".config")
+    files = [
+        Path(os.environ.get("GIT_CONFIG_SYSTEM", "/etc/gitconfig")),
+        xdg_config / "git" / "config",
+        Path(os.environ.get("GIT_CONFIG_GLOBAL", home / ".gitconfig")),
+    ]
+    if not git_dir:
+        return files
+    git_dir = Path(git_dir)
+    common_dir = git_dir
+    if (git_dir / "commondir").exists():
+        # linked worktrees share configuration with the main repository
+        common_dir = (git_dir / (git_dir / "commondir").read_text().strip()).resolve()
+    return files + [common_dir / "config", git_dir / "config.worktree"]
+
+
+def _mtime(path):
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def read_gerrit_section(git_dir=None):
+    """Returns dict of gerrit.* keys (without the section prefix) set in git configuration of the repository, or
+    in system and user configuration when git_dir is None
+
+    Modifications of files included with [include] path are noticed only when one of the main files changes too.
+    """
+    files = _config_files(git_dir)
+    key = tuple((str(path), _mtime(path)) for path in files)
+    if key not in _SECTIONS:
+        section = {}
+        for path, mtime in zip(files, key):
+            if mtime[1] is not None:
+                _parse(path, section)
+        LOGGER.debug(f"Read gerrit keys from git configuration: {sorted(section)}")
+        _SECTIONS[key] = section
+    return _SECTIONS[key]
+
+
+def _parse(path, section, depth=0):
+    """Updates section with gerrit keys of the file, later values override earlier ones like in git"""
+    try:
+        lines = path.read_text(encoding="utf-8", errors="replace").splitlines()
+    except OSError as error:
+        LOGGER.debug(f"Skipping unreadable git configuration {path}: {error}")
+        return
+
+    current = None
+    pending = ""
+    for line in lines:
+        line = pending + line
+        pending = ""
+        if _continues(line):
+            pending = line[:-1]
+            continue
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        match = RE_SECTION.match(line)
+        if match:
+            current = (match.group("section").lower(), match.group("subsection"))
+            line = match.group("rest").strip()
+            if not line or line[0] in "#;":
+                continue
+        name, equals, value = line.partition("=")
+        name = name.strip().lower()
+        value = _value(value) if equals else "true"
+        if current == ("gerrit", None):
+            section[name] = value
+        elif current == ("include", None) and name == "path" and depth < MAX_INCLUDE_DEPTH:
+            _parse(path.parent / Path(value).expanduser(), section, depth + 1)
+
+
+def _continues(line):
+    """Line ending with odd number of backslashes continues on the next line"""
+    return (len(line) - len(line.rstrip("\\"))) % 2 == 1
+
+
+def _value(raw):
+    """Unquotes and unescapes value, dropping trailing comment"""
+    result = []
+    quoted = False
+    chars = iter(raw.strip())
+    for char in chars:
+        if char == '"':
+            quoted = not quoted
+        elif char == "\\":
+            escaped = next(chars, "")
+            result.append(ESCAPES.get(escaped, escaped))
+        elif char in "#;" and not quoted:
+            break
+        else:
+            result.append(char)
+    return "".join(result).strip()
@@ -0,0 +1,215 @@
+"""Forwarding of git-gerrit invocations to a long-lived background process.
+
+Only standard library is imported on module level so that forwarding a command to a running daemon does
+not pay for importing git or gerrit libraries.
+"""
+import json
+import os
+import socket
+import sys
+import tempfile
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+
+# Environment variables that affect how a command is executed and are thus passed from the client to the daemon
+FORWARDED_ENV_PREFIXES = ("GERRIT_", "GIT_", "WORKSPACE")
+NO_DAEMON_ENV = "GITGERRIT_NO_DAEMON"
+# Daemon executes one command at a time. If it does not greet in this many seconds, it is busy with a long command,
+# like runverify --wait, and the invocation runs in-process instead
+READY_TIMEOUT = 0.5
+
+
+def socket_path():
+    """Per-user location of the daemon socket"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "git-gerrit.sock")
+    return os.path.join(tempfile.gettempdir(), f"git-gerrit-{os.getuid()}.sock")
+
+
+def _connect():
+    if not hasattr(socket, "AF_UNIX") or os.environ.get(NO_DAEMON_ENV):
+        return None
+    path = socket_path()
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+    except OSError:
+        return None
+    return client
+
+
+def _send(stream, message):
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+def _batch_reads_stdin(argv):
+    for index, arg in enumerate(argv):
+        if arg in ("-f", "--file"):
+            return argv[index + 1 : index + 2] == ["-"]
+        if arg.startswith("--file="):
+            return arg == "--file=-"
+    return True
+
+
+def forward(argv):
+    """Executes the invocation in a running daemon. Returns exit code or None when no daemon is available"""
+    if "daemon" in argv:
+        # stopping does not need repository or configuration so it is handled without importing the rest of the tool
+        if "--stop" in argv and stop_daemon():
+            return 0
+        return None
+    if "batch" in argv and _batch_reads_stdin(argv):
+        # daemon cannot read our stdin
+        return None
+    client = _connect()
+    if client is None:
+        return None
+
+    env = {key: value for key, value in os.environ.items() if key.startswith(FORWARDED_ENV_PREFIXES)}
+    with client, client.makefile("rwb") as stream:
+        # command is sent only after the greeting, so a busy daemon never executes it later on
+        client.settimeout(READY_TIMEOUT)
+        try:
+            if not stream.readline():
+                return None
+        except socket.timeout:
+            return None
+        client.settimeout(None)
+        _send(stream, {"argv": argv, "cwd": os.getcwd(), "env": env})
+        for line in stream:
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+            target = sys.stdout if message["stream"] == "out" else sys.stderr
+            target.write(message["data"])
+            target.flush()
+    # daemon went away in the middle of the command
+    return 1
+
+
+def stop_daemon():
+    """Asks running daemon to exit, returns False if there was no daemon to stop"""
+    client = _connect()
+    if client is None:
+        return False
+    with client, client.makefile("rwb") as stream:
+        stream.readline()  # greeting, after the command being executed has completed
+        _send(stream, {"stop": True})
+        stream.readline()
+    return True
+
+
+class _Channel:
+    """File like object that sends everything written into it to the client as framed messages"""
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def write(self, data):
+        if data:
+            _send(self.stream, {"stream": self.name, "data": data})
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+@contextmanager
+def _client_environment(cwd, env):
+    """Switches working directory and forwarded environment variables to the ones of the client"""
+    original_cwd = os.getcwd()
+    original_env = {key: value for key, value in os.environ.items() if key.startswith(FORWARDED_ENV_PREFIXES)}
+    for key in original_env:
+        del os.environ[key]
+    os.environ.update(env)
+    os.chdir(cwd)
+    try:
+        yield
+    finally:
+        os.chdir(original_cwd)
+        for key in env:
+            os.environ.pop(key, None)
+        os.environ.update(original_env)
+
+
+def _execute(session, argv):
+    from .gitgerrit import run
+    from .logger import LOGGER
+
+    try:
+        run(argv, session)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception as e:  # noqa: B902 - daemon must survive failing commands
+        LOGGER.exception(f"Unexpected error: {e}")
+        return 1
+    return 0
+
+
+def serve(session, idle_timeout):
+    """Serves forwarded invocations one at a time until stopped or idle for idle_timeout seconds"""
+    import socketserver
+    from .logger import LOGGER, log_stream
+
+    path = socket_path()
+    if _connect() is not None:
+        raise RuntimeError(f"git-gerrit daemon is already running at {path}")
+    if os.path.exists(path):
+        os.unlink(path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                _send(self.wfile, {"ready": True})
+            except OSError:
+                return  # client gave up waiting while previous command was executed
+            line = self.rfile.readline()
+            if not line:
+                # connection probe, for example from another daemon checking if this one is alive
+                return
+            request = json.loads(line)
+            if request.get("stop"):
+                self.server.running = False
+                _send(self.wfile, {"exit": 0})
+                return
+            out = _Channel(self.wfile, "out")
+            err = _Channel(self.wfile, "err")
+            with _client_environment(request["cwd"], request["env"]):
+                with redirect_stdout(out), redirect_stderr(err), log_stream(err):
+                    exit_code = _execute(session, request["argv"])
+            _send(self.wfile, {"exit": exit_code})
+
+    class Server(socketserver.UnixStreamServer):
+        running = True
+
+        def handle_timeout(self):
+            LOGGER.info(f"No commands in {idle_timeout} seconds, exiting")
+            self.running = False
+
+        def handle_error(self, request, client_address):
+            LOGGER.exception("Failed to serve forwarded command")
+
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+
+    LOGGER.info(f"git-gerrit daemon listening on {path}")
+    server.timeout = idle_timeout
+    try:
+        with server:
+            while server.running:
+                server.handle_request()
+    finally:
+        os.unlink(path)
@@ -3,20 +3,53 @@ import os
 import re
 import argparse
 import sys
-import git
 import requests
 import json
 import ntpath
+import shlex
+import copy
+import subprocess
+import hashlib
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import time
+import logging
 from typing import Union, Dict, List
-from pygerrit2 import GerritRestAPI, HTTPBasicAuth
-from .logger import LOGGER, _APPNAME, LOG_LEVELS, log_decorator
+from urllib.parse import quote, unquote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pygerrit2 import HTTPBasicAuth
+from . import codec
+from .config import read_gerrit_section
+from .repo import LazyRepo, find_repositories
+from .changeids import ChangeIds
+from .responsecache import ResponseCache
+from .client import GerritClient, DEFAULT_BURST, options_for_fields, http_error
+from .plan import plan_prepare, plan_hashtags, plan_state, plan_topic, run_plan, order_by_change
+from .output import Output, OUTPUT_FORMATS
+from .attribution import chain_commits, route_comments
+from .remap import remap_comments
+from .comments import load_review_input
+from .progress import Progress
+from .logger import LOGGER, _APPNAME, LOG_LEVELS, LOG_FORMATS, log_decorator, configure_logging, set_log_context, log_event
 from ._version import get_versions
 
 __version__ = get_versions()["version"]
 DEFAULT_TRIGGER = "runverify"
 DEFAULT_PREVENT_BUILD_TOPIC = "NOCI"
-RE_CHANGEID = re.compile(r"change-id:\s+(?P<changeid>I[a-z0-9]+)", re.IGNORECASE | re.MULTILINE)
+RE_CHANGEID = re.compile(r"^I[0-9a-f]{40}$")
 NOTIFY_OPTIONS = ["NONE", "OWNER", "OWNER_REVIEWERS", "ALL"]
+# Configuration keys that may be left unset and their names in gerrit section, read lower cased. Git does not allow
+# underscores in names of variables, environment variables are GERRIT_<KEY.upper()>
+OPTIONAL_KEYS = {"rate_limit": "ratelimit", "burst": "burst", "shared_cache": "sharedcache"}
+QUERY_PAGE_SIZE = 100
+QUERY_CHUNK_SIZE = 50
+VERIFIED_LABEL = "Verified"
+VOTE_LABELS = ["Code-Review", VERIFIED_LABEL]
+POLL_BACKOFF = 1.5
+POLL_MAX_INTERVAL = 120
+POLL_JITTER = 0.1
+REPO_WORKERS = 8
 
 
 @log_decorator
@@ -24,33 +57,10 @@ def prepare(rest, git_repo, args, gerrit_config):
     LOGGER.info(
         f"Preparing the change to be ready for merge\nAdds hashtags, Ready-For-Review and Public and {gerrit_config['prevent_build_topic']} topic to all but HEAD"
     )
-    chain = args.commit_chain or [args.changeid]
-    change_details = get_change_detail(rest, chain[0])
-
-    topic_to_set = change_details["topic"]  # set to branch name if topic is not set
-    for change in chain:
-        set_change_hashtags(rest, change, adds=[topic_to_set])
-        mark_as_public(rest, change)
-        mark_as_ready_for_review(rest, change)
-
-    for change in chain[1:]:
-        change_topic(rest, change, gerrit_config["prevent_build_topic"])
-
-
-@log_decorator
-def set_change_hashtags(rest, change, adds=None, removes=None):
-    payload = {}
-    if removes:
-        payload["remove"] = removes
-    if adds:
-        payload["add"] = adds
-
-    try:
-        return rest.post(f"/changes/{change}/hashtags", data=payload)
-    except requests.exceptions.HTTPError as e:
-        LOGGER.debug(f"HTTP Error Occured: {str(e)}")
-        if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({change}) cannot be found on remote gerrit server.")
+    # query results and commit ranges are not a chain, each change is prepared as its own HEAD
+    changes = get_target_changes(rest, args, cached=False)
+    is_chain = not args.query and not args.commits
+    run_plan(rest, args, plan_prepare(changes, gerrit_config["prevent_build_topic"], is_chain=is_chain))
 
 
 @log_decorator
@@ -60,65 +70,69 @@ def get_change_hashtags(rest, change):
     except requests.exceptions.HTTPError as e:
         LOGGER.debug(f"HTTP Error Occured: {str(e)}")
         if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({change}) cannot be found on remote gerrit server.")
+            raise http_error(e, change)
 
 
 @log_decorator
-def print_hashtags(rest, commit_chain):
-    for change in commit_chain:
-        tags = get_change_hashtags(rest, change)
-        LOGGER.info(f" * {change}: {', '.join(tags)}")
+def print_hashtags(rest, commit_chain, output):
+    # query results are a generator
+    with Progress(rest, len(commit_chain) if isinstance(commit_chain, list) else None) as progress:
+        for change in commit_chain:
+            tags = get_change_hashtags(rest, change)
+            output.emit("hashtags", {"change": change, "hashtags": tags}, f" * {change}: {', '.join(tags)}")
+            progress.advance()
 
 
 @log_decorator
 def hashtag(rest, git_repo, args, gerrit_config):
-    chain = args.commit_chain or [args.changeid]
     if args.check:
-        print_hashtags(rest, chain)
+        print_hashtags(rest, get_targets(rest, args), args.output)
     else:
         if not args.add_tags and not args.remove_tags:
             args.add_tags = [git_repo.active_branch.name]
 
-        for change in chain:
-            set_change_hashtags(rest, change, args.add_tags, args.remove_tags)
+        run_plan(rest, args, plan_hashtags(get_target_changes(rest, args, cached=False), args.add_tags, args.remove_tags))
 
 
 @log_decorator
-def get_git_root() -> git.repo.base.Repo:
-    """ Tries to locate a the root of the current git repository and and returns Repo instance"""
-    ## Fix this to work correctly ..
-    entry = Path.cwd().absolute()
-    try:
-        return git.Repo(entry, search_parent_directories=True)
-    except Exception as error:
-        pass
-
-    try:
-        entry = Path(os.environ.get("WORKSPACE", ".")).absolute()
-        return git.Repo(entry, search_parent_directories=True)
-    except Exception as error:
-        raise RuntimeError(f"Creating git repo object from {entry} failed with error: {error}!")
+def get_git_root() -> LazyRepo:
+    """Returns repository containing current directory or $WORKSPACE. Repository is only located when first used"""
+    return LazyRepo([Path.cwd().absolute(), Path(os.environ.get("WORKSPACE", ".")).absolute()])
 
 
 @log_decorator
-def get_change_detail(rest, changeid):
+def get_change_detail(rest, changeid, fields=None):
+    """Returns ChangeInfo of the change with at least the given fields populated"""
+    options = "&".join(f"o={option}" for option in options_for_fields(fields))
     try:
-        return rest.get(f"/changes/{changeid}/detail?o=CURRENT_REVISION&o=CURRENT_COMMIT&o=WEB_LINKS")
+        return rest.get(f"/changes/{changeid}" + (f"?{options}" if options else ""))
     except requests.exceptions.HTTPError as e:
         LOGGER.debug(f"HTTP Error Occured: {str(e)}")
         if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({changeid}) cannot be found on remote gerrit server.")
+            raise http_error(e, changeid)
 
 
 @log_decorator
-def print_votes(changedata):
-    for label in ["Code-Review", "Verified"]:
-        LOGGER.info(f"{label}:")
-        try:
-            for vote in changedata["labels"][label]["all"]:
-                LOGGER.info(f" * {vote['name']:30}{vote['value']}")
-        except KeyError:
-            pass
+def print_votes(changes, gerrit_config, output):
+    """Outputs votes of every change, shown as a table with one row per change"""
+    for change in changes:
+        url = f"https://{gerrit_config['host']}/c/{change['project']}/+/{change['_number']}"
+        votes = {}
+        cells = {"Change": url}
+        for label in VOTE_LABELS:
+            label_votes = change.get("labels", {}).get(label, {}).get("all", [])
+            votes[label] = [{"voter": _voter(vote), "value": vote.get("value", 0)} for vote in label_votes]
+            cells[label] = ", ".join(f"{_voter(vote)} {_vote_value(vote)}" for vote in label_votes)
+        output.emit("votes", {"change": change["change_id"], "url": url, "votes": votes}, cells=cells)
+
+
+def _voter(vote):
+    return vote.get("name") or vote.get("username") or str(vote.get("_account_id", "?"))
+
+
+def _vote_value(vote):
+    value = vote.get("value", 0)
+    return f"{value:+d}" if value else "0"
 
 
 @log_decorator
@@ -129,107 +143,192 @@ def trigger_run_verify(rest, changeid, revision, trigger):
 
 @log_decorator
 def runverify(rest, git_repo, args, gerrit_config):
-    response = get_change_detail(rest, args.changeid)
     if args.check:
-        LOGGER.info(f"https://{gerrit_config['host']}/c/{response['project']}/+/{response['_number']}")
-        print_votes(response)
-    else:
-        current_rev = response["current_revision"]
-        revision = response["revisions"][current_rev]["_number"]
-        trigger_run_verify(rest, args.changeid, revision, gerrit_config["trigger"])
+        if args.wait:
+            wait_for_verification(rest, args, gerrit_config)
+        else:
+            print_votes(get_target_changes(rest, args, fields=["votes", "voters"]), gerrit_config, args.output)
+        return
+
+    if args.dry_run:
+        raise RuntimeError("runverify supports --dry-run only with --check")
+    # every trigger moves the change to the top of the query results, read all pages before triggering any
+    changes = list(get_targets(rest, args)) if args.query or args.commits else [args.changeid]
+    triggered_at = None
+    with Progress(rest, len(changes)) as progress:
+        for change in changes:
+            _, trigger_response = trigger_run_verify(rest, change, args.revision or "current", gerrit_config["trigger"])
+            if triggered_at is None:
+                triggered_at = parsedate_to_datetime(trigger_response.headers["Date"])
+            progress.advance()
+
+    if args.wait:
+        wait_for_verification(rest, args, gerrit_config, triggered_at)
+
+
+def _parse_gerrit_timestamp(timestamp):
+    return datetime.strptime(timestamp[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+
+
+def verified_state(change, since=None):
+    """Returns "approved", "rejected", "merged" or "abandoned" if change has its final Verified state, None otherwise
+
+    If since is given, only votes cast after it are considered, so that votes of earlier ci runs do not count.
+    """
+    if change.get("status") in ("MERGED", "ABANDONED"):
+        return change["status"].lower()
+    label = change.get("labels", {}).get(VERIFIED_LABEL, {})
+    if since is None:
+        for state in ("rejected", "approved"):
+            if state in label:
+                return state
+        return None
+
+    votes = [
+        vote.get("value", 0)
+        for vote in label.get("all", [])
+        if "date" in vote and _parse_gerrit_timestamp(vote["date"]) >= since
+    ]
+    if any(value < 0 for value in votes):
+        return "rejected"
+    if "approved" in label and any(value > 0 for value in votes):
+        return "approved"
+    return None
+
+
+@log_decorator
+def wait_for_verification(rest, args, gerrit_config, since=None):
+    """Polls Verified votes of all targets with one query per round until every change has a final vote"""
+    # label summary tells if label is approved or rejected, vote dates are only in detailed votes
+    fields = ["labels", "topic"] if since is None else ["labels", "votes", "topic"]
+    deadline = time.monotonic() + args.timeout
+    interval = args.poll_interval
+    states = {}
+    while True:
+        changed = False
+        pending = []
+        # cached responses would hide votes cast since
+        for change in get_target_changes(rest, args, fields, cached=False):
+            if gerrit_config["prevent_build_topic"] in change.get("topic", "").upper():
+                continue  # ci does not build these
+            state = verified_state(change, since)
+            if change["id"] not in states or states[change["id"]] != state:
+                changed = True
+                args.output.emit(
+                    "verification",
+                    {"change": change["change_id"], "state": state or "waiting"},
+                    f" * {change['change_id']}: {state or 'waiting'}",
+                )
+            states[change["id"]] = state
+            if state is None:
+                pending.append(change["change_id"])
+
+        if not pending:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RuntimeError(f"Timed out waiting for {VERIFIED_LABEL} votes on: {', '.join(pending)}")
+        # poll quickly while votes are coming in, slow down when nothing happens
+        interval = args.poll_interval if changed else min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+        time.sleep(min(interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER), remaining))
+
+    rejected = [change for change, state in states.items() if state == "rejected"]
+    if rejected:
+        raise RuntimeError(f"{VERIFIED_LABEL} rejected on: {', '.join(rejected)}")
 
 
 @log_decorator
 def workinprogress(gerrit_api, git_repo, args, gerrit_config):
-    chain = args.commit_chain or [args.changeid]
-    output_buffer = "Marking following changes as work-in-progress:\n * {changes}\n".format(changes="\n * ".join(chain))
-    LOGGER.info(output_buffer)
-    for change in chain:
-        mark_as_work_in_progress(gerrit_api, change, args.message)
+    LOGGER.info("Marking following changes as work-in-progress:")
+    run_plan(gerrit_api, args, plan_state(get_target_changes(gerrit_api, args, cached=False), "wip", args.message))
 
 
 @log_decorator
 def makepublic(gerrit_api, git_repo, args, gerrit_config):
-    chain = args.commit_chain or [args.changeid]
-    output_buffer = "Marking following changes as public:\n * {changes}\n".format(changes="\n * ".join(chain))
-    LOGGER.info(output_buffer)
-    for change in chain:
-        mark_as_public(gerrit_api, change, args.message)
+    LOGGER.info("Marking following changes as public:")
+    run_plan(gerrit_api, args, plan_state(get_target_changes(gerrit_api, args, cached=False), "public", args.message))
 
 
 @log_decorator
 def makeprivate(gerrit_api, git_repo, args, gerrit_config):
-    chain = args.commit_chain or [args.changeid]
-    output_buffer = "Marking following changes as private:\n * {changes}\n".format(changes="\n * ".join(chain))
-    LOGGER.info(output_buffer)
-    for change in chain:
-        mark_as_private(gerrit_api, change, args.message)
+    LOGGER.info("Marking following changes as private:")
+    run_plan(gerrit_api, args, plan_state(get_target_changes(gerrit_api, args, cached=False), "private", args.message))
 
 
 @log_decorator
 def readyforreview(gerrit_api, git_repo, args, gerrit_config):
-    chain = args.commit_chain or [args.changeid]
-    output_buffer = "Marking following changes as ready for review:\n * {changes}\n".format(changes="\n * ".join(chain))
-    LOGGER.info(output_buffer)
-    for change in chain:
-        mark_as_ready_for_review(gerrit_api, change, args.message)
+    LOGGER.info("Marking following changes as ready for review:")
+    run_plan(gerrit_api, args, plan_state(get_target_changes(gerrit_api, args, cached=False), "ready", args.message))
 
 
 @log_decorator
 def abandon(gerrit_api, git_repo, args, gerrit_config):
-    chain = args.commit_chain or [args.changeid]
-    output_buffer = "Abandoning following changes:\n * {changes}\n".format(changes="\n * ".join(chain))
-    LOGGER.info(output_buffer)
-    for change in chain:
-        abandon_change(gerrit_api, change)
-
-
-@log_decorator
-def change_topic(gerrit_api, changeid, topic):
-    try:
-        return gerrit_api.put(f"/changes/{changeid}/topic", data={"topic": topic})
-    except requests.exceptions.HTTPError as e:
-        LOGGER.debug(f"HTTP Error Occured: {str(e)}")
-        if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({changeid}) cannot be found on remote gerrit server.")
-    return gerrit_api.put(f"/changes/{changeid}/topic", data={"topic": topic})
+    LOGGER.info("Abandoning following changes:")
+    run_plan(gerrit_api, args, plan_state(get_target_changes(gerrit_api, args, cached=False), "abandon"))
 
 
 @log_decorator
 def topic(gerrit_api, git_repo, args, gerrit_config):
-    chain = args.commit_chain or [args.changeid]
+    if args.query or args.commits:
+        if args.check:
+            LOGGER.info("List of topics:")
+            for change in get_target_changes(gerrit_api, args):
+                topic = change.get("topic", "")
+                args.output.emit("topic", {"change": change["id"], "topic": topic}, f" * {change['id']} - {topic}")
+        else:
+            LOGGER.info(f"Changing topic of the changes to {args.topic}")
+            run_plan(gerrit_api, args, plan_topic(get_target_changes(gerrit_api, args, cached=False), args.topic))
+        return
 
+    chain = args.commit_chain or [args.changeid]
     if args.check:
         LOGGER.info("List of topics:")
-        for change in chain:
-            change_details = get_change_detail(gerrit_api, change)
-            LOGGER.info(f" * {change} - {change_details['topic']}")
+        with Progress(gerrit_api, len(chain)) as progress:
+            for change in chain:
+                topic = get_change_detail(gerrit_api, change, fields=["topic"]).get("topic", "")
+                args.output.emit("topic", {"change": change, "topic": topic}, f" * {change} - {topic}")
+                progress.advance()
     else:
         if len(chain) > 1:
             LOGGER.info(f"Changing topic of the commit chain parents to {args.topic}")
             idx = 0
             if gerrit_config["prevent_build_topic"] in args.topic.upper():
                 idx = 1
-            for change in chain[idx:]:
-                change_topic(gerrit_api, change, args.topic)
+            changes = get_target_changes(gerrit_api, args, cached=False)
+            changes = [change for change in changes if change["change_id"] not in chain[:idx]]
+            run_plan(gerrit_api, args, plan_topic(changes, args.topic))
         else:
             if args.support_chain and gerrit_config["prevent_build_topic"] in args.topic.upper():
                 raise RuntimeError(f"Your commit chain has only 1 change, cannot set topic to {args.topic}")
 
             LOGGER.info(f"Changing topic the commit to {args.topic}")
-            change_topic(gerrit_api, chain[0], args.topic)
+            run_plan(gerrit_api, args, plan_topic(get_target_changes(gerrit_api, args, cached=False), args.topic))
 
 
-def parse_args(gerrit_config):
+def parse_args(gerrit_config, argv, configure_logging_from_args=True):
     parser = argparse.ArgumentParser(
         prog=_APPNAME,
         description="gerrit codereview features from command line",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        epilog="If/when no changeid or commit is provided, operations are done against current commit in current branch",
+        epilog="If/when no changeid, commit or query is provided, operations are done against current commit in current branch",
     )
     parser.add_argument(
         "-l", "--loglevel", default="info", dest="loglevel", choices=list(LOG_LEVELS.keys())[1:], help="Log Level"
     )
+    parser.add_argument(
+        "--log-format",
+        default="text",
+        dest="log_format",
+        choices=LOG_FORMATS,
+        help="Log output format, json emits one structured record per line",
+    )
+    parser.add_argument(
+        "--format",
+        default="text",
+        dest="output_format",
+        choices=OUTPUT_FORMATS,
+        help="Format of results in stdout, ndjson writes each result as soon as its request completes",
+    )
     parser.add_argument("-v", "--version", action="version", version="%(prog)s {version}".format(version=__version__))
 
     parser.add_argument(
@@ -239,6 +338,33 @@ def parse_args(gerrit_config):
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--changeid", default=None, metavar="N", type=str, help="Gerrit Change-Id top operate on")
     group.add_argument("--commit", default=None, metavar="N", type=str, help="Commit sha to operate on")
+    group.add_argument(
+        "--query", default=None, metavar="Q", type=str, help="Operate on every change matching gerrit search query"
+    )
+    group.add_argument(
+        "--commits", default=None, metavar="A..B", type=str, help="Operate on changes of every commit in the range"
+    )
+    parser.add_argument(
+        "--dry-run",
+        "--plan",
+        dest="dry_run",
+        action="store_true",
+        default=False,
+        help="Print requests that would be sent, with their estimated cost, without changing anything",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Skip operations that an earlier, interrupted run of the same command already completed",
+    )
+    parser.add_argument(
+        "--repos",
+        default=None,
+        metavar="G",
+        help="Run the action in every git repository matching glob pattern or listed in repo tool manifest (.xml)",
+    )
+    parser.set_defaults(resolve_targets=True, revision=None)
     sub_parsers = parser.add_subparsers()
 
     review_parser = sub_parsers.add_parser(
@@ -274,12 +400,34 @@ def parse_args(gerrit_config):
         help=f"To whom should notification email send about this review. Available options: {','.join(NOTIFY_OPTIONS)}"
     )
     review_parser.add_argument("-k", "--keep-labels", dest="keep_labels", action="store_true", default=False, help="If payload has votes, do not remove them.")
+    review_parser.add_argument(
+        "--base-revision",
+        dest="base_revision",
+        default=None,
+        metavar="R",
+        help="Commit the payload was created from, comments are moved to the lines of the current patch set",
+    )
     review_parser.set_defaults(cmd=review)
 
     runverify_parser = sub_parsers.add_parser(
         "runverify", help="Trigger or check +1 check state of change(s)", formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
-    runverify_parser.add_argument("-c", "--check", action="store_true", default=False, help="Prints votes on latest revision")
+    runverify_parser.add_argument(
+        "-c", "--check", action="store_true", default=False, help="Prints votes on latest revision of change(s)"
+    )
+    runverify_parser.add_argument(
+        "-w",
+        "--wait",
+        action="store_true",
+        default=False,
+        help=f"Wait until every change has final {VERIFIED_LABEL} vote. Fails if any of them is rejected",
+    )
+    runverify_parser.add_argument(
+        "--timeout", dest="timeout", type=int, default=3600, metavar="S", help="Give up waiting after S seconds"
+    )
+    runverify_parser.add_argument(
+        "--poll-interval", dest="poll_interval", type=int, default=15, metavar="S", help="Initial seconds between polls"
+    )
     runverify_parser.set_defaults(cmd=runverify)
 
     topic_parser = sub_parsers.add_parser(
@@ -332,13 +480,72 @@ def parse_args(gerrit_config):
     )
     prepare_parser.set_defaults(cmd=prepare)
 
+    push_parser = sub_parsers.add_parser(
+        "push",
+        help="uploads commit(s) for review, setting topic, hashtags, state and reviewers while pushing",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    push_parser.add_argument("--remote", default=None, metavar="R", help="Remote to push into, defaults to upstream remote")
+    push_parser.add_argument(
+        "-b", "--branch", default=None, metavar="B", help="Target branch, defaults to upstream branch or master"
+    )
+    push_parser.add_argument("-t", "--topic", default=None, help="Topic of the pushed change, HEAD of the chain")
+    push_parser.add_argument(
+        "-a", "--hashtag", dest="hashtags", action="append", default=None, help="hashtag, defaults to current branch name"
+    )
+    push_parser.add_argument("-r", "--reviewer", dest="reviewers", action="append", default=None, help="add reviewer")
+    push_state_group = push_parser.add_mutually_exclusive_group()
+    push_state_group.add_argument("--wip", action="store_true", default=False, help="Mark change(s) as Work-In-Progress")
+    push_state_group.add_argument("--ready", action="store_true", default=False, help="Mark change(s) as Ready-For-Review")
+    push_private_group = push_parser.add_mutually_exclusive_group()
+    push_private_group.add_argument("--private", action="store_true", default=False, help="Mark change(s) as Private")
+    push_private_group.add_argument(
+        "--remove-private", dest="remove_private", action="store_true", default=False, help="Mark change(s) as Public"
+    )
+    push_parser.set_defaults(cmd=push, resolve_targets=False)
+
     abandon_parser = sub_parsers.add_parser(
         "abandon", help="abandon change(s)", formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     abandon_parser.set_defaults(cmd=abandon)
 
-    args = parser.parse_args(sys.argv[1:])
-    LOGGER.setLevel(LOG_LEVELS[args.loglevel])
+    batch_parser = sub_parsers.add_parser(
+        "batch",
+        help="executes commands from a script, one command per line, over a single session",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    batch_parser.add_argument(
+        "-f", "--file", dest="script", type=Path, default=Path("-"), metavar="F", help="script to read commands from, - for stdin"
+    )
+    batch_parser.add_argument(
+        "-k", "--keep-going", dest="keep_going", action="store_true", default=False, help="Continue after failing command"
+    )
+    batch_parser.add_argument(
+        "--fuse",
+        action="store_true",
+        default=False,
+        help="Merge state changes of consecutive commands into as few requests per change as possible",
+    )
+    # targets of the batch itself are resolved only if some line of the script uses them
+    batch_parser.set_defaults(cmd=batch, resolve_targets=False)
+
+    daemon_parser = sub_parsers.add_parser(
+        "daemon",
+        help="runs in background and executes forwarded commands with warm connections and caches",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    daemon_parser.add_argument(
+        "--idle-timeout", dest="idle_timeout", type=int, default=3600, metavar="S", help="Exit after S seconds without commands"
+    )
+    daemon_parser.add_argument(
+        "--cache-ttl", dest="cache_ttl", type=int, default=10, metavar="S", help="Seconds to keep gerrit responses cached"
+    )
+    daemon_parser.add_argument("--stop", action="store_true", default=False, help="Stops running daemon")
+    daemon_parser.set_defaults(cmd=daemon, resolve_targets=False)
+
+    args = parser.parse_args(argv)
+    if configure_logging_from_args:
+        configure_logging(args.loglevel, args.log_format)
     if "cmd" not in args:
         parser.print_help()
         sys.exit(0)
@@ -346,46 +553,64 @@ def parse_args(gerrit_config):
 
 
 @log_decorator
-def get_gerrit_configuration(cfg):
+def get_gerrit_configuration(git_repo):
     result = {}
     base_error = "Configuration Error"
     keys = ["user", "token", "host"]
-    if cfg.has_section("gerrit"):
+    if all(os.environ.get(f"GERRIT_{key.upper()}") for key in keys):
+        LOGGER.debug("Gerrit configuration found in environment variables, not reading git config")
+        section = {}
+    else:
+        section = read_gerrit_section(git_repo.git_dir)
+
+    if section:
         LOGGER.debug("Found gerrit section in git config, using it for configuring git-gerrit")
         for key in keys:
-            if not cfg.has_option("gerrit", key):
+            if key not in section:
                 raise RuntimeError(f"{base_error}: missing option '{key}' in section gerrit in your git configuration")
-            result[key] = cfg.get("gerrit", key)
-
-        if cfg.has_option("gerrit", "trigger"):
-            result["trigger"] = cfg.get("gerrit", "trigger")
-        else:
-            result["trigger"] = DEFAULT_TRIGGER
+            result[key] = section[key]
 
-        if cfg.has_option("gerrit", "prevent_build_topic"):
-            result["prevent_build_topic"] = cfg.get("gerrit", "prevent_build_topic")
-        else:
-            result["prevent_build_topic"] = DEFAULT_PREVENT_BUILD_TOPIC
+        result["trigger"] = section.get("trigger", DEFAULT_TRIGGER)
+        result["prevent_build_topic"] = section.get("prevent_build_topic", DEFAULT_PREVENT_BUILD_TOPIC)
+        for key, name in OPTIONAL_KEYS.items():
+            result[key] = section.get(name)
     else:
         LOGGER.debug("No gerrit section in git config, using environment variables as fallback configuration")
         for key in keys:
             result[key] = os.environ.get(f"GERRIT_{key.upper()}", None)
 
         result["trigger"] = os.environ.get("GERRIT_TRIGGER", DEFAULT_TRIGGER)
-        result["prevent_build_topic"] = os.environ.get("GERRIT_PREVENT_BUILD_TOPIC", DEFAULT_TRIGGER)
+        result["prevent_build_topic"] = os.environ.get("GERRIT_PREVENT_BUILD_TOPIC", DEFAULT_PREVENT_BUILD_TOPIC)
         if None in result.values():
             raise RuntimeError(
                 f"{base_error}: missing gerrit section in your git configuration and no fallback values in environment"
             )
+        for key in OPTIONAL_KEYS:
+            result[key] = os.environ.get(f"GERRIT_{key.upper()}", None)
+
+    try:
+        result["rate_limit"] = float(result["rate_limit"]) if result["rate_limit"] else None
+        result["burst"] = int(result["burst"]) if result["burst"] else DEFAULT_BURST
+    except ValueError:
+        raise RuntimeError(f"{base_error}: rateLimit must be a number and burst an integer")
 
     return result
 
 
 @log_decorator
-def get_gerrit_api(gerrit_config, verify_ssl=True):
-    """Returns GerritRestAPI instance with authentication details"""
+def get_gerrit_api(gerrit_config, verify_ssl=True, cache_ttl=0):
+    """Returns GerritClient instance with authentication details"""
     auth = HTTPBasicAuth(gerrit_config["user"], gerrit_config["token"])
-    rest = GerritRestAPI(url=f"https://{gerrit_config['host']}", auth=auth, verify=verify_ssl)
+    rest = GerritClient(
+        url=f"https://{gerrit_config['host']}",
+        auth=auth,
+        verify=verify_ssl,
+        cache_ttl=cache_ttl,
+        rate_limit=gerrit_config["rate_limit"],
+        burst=gerrit_config["burst"],
+        change_ids=ChangeIds.for_host(gerrit_config["host"]),
+        shared_cache=ResponseCache.from_config(gerrit_config["shared_cache"], gerrit_config["host"], gerrit_config["user"]),
+    )
     log_cfg = gerrit_config.copy()
     log_cfg["token"] = "<HIDDEN>"
     LOGGER.debug(f"Config: {log_cfg}")
@@ -395,174 +620,453 @@ def get_gerrit_api(gerrit_config, verify_ssl=True):
 
 @log_decorator
 def get_changeid_of_commit(git_repo, commit):
-    commit = git_repo.commit(commit)
-    search_result = RE_CHANGEID.search(commit.message)
-    if search_result:
-        return search_result.group("changeid")
-    return None
+    changeids = get_changeids_of_commits(git_repo, ["-1", commit])
+    return changeids[0] if changeids else None
 
 
 @log_decorator
-def abandon_change(rest, changeid):
-    try:
-        return rest.post(f"/changes/{changeid}/abandon")
-    except requests.exceptions.HTTPError as e:
-        LOGGER.debug(f"HTTP Error Occured: {str(e)}")
-        if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({changeid}) cannot be found on remote gerrit server.")
+def get_changeids_of_commits(git_repo, revisions):
+    """Returns Change-Ids of the commits git log lists for revisions (like a rev-list range), newest first.
+
+    Change-Id is read from the trailers of each commit message in a single streaming git log pass, so ids mentioned
+    in message bodies (like in reverts) are not picked up. Commits without Change-Id are skipped.
+    """
+    command = ["git", "log", "--format=%x00%(trailers:key=Change-Id,valueonly)"] + revisions + ["--"]
+    process = subprocess.Popen(command, cwd=git_repo.working_tree_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    changeids = {}
+    commits = 0
+    trailers = []
+    for line in process.stdout:
+        if line.startswith(b"\0"):
+            commits += 1
+            if trailers:
+                changeids[trailers[-1]] = None  # gerrit uses the last Change-Id
+            trailers = []
+            line = line[1:]
+        value = line.strip().decode("utf-8", "replace")
+        if RE_CHANGEID.match(value):
+            trailers.append(value)
+    if trailers:
+        changeids[trailers[-1]] = None
+    errors = process.stderr.read().decode("utf-8", "replace").strip()
+    if process.wait() != 0:
+        raise RuntimeError(f"Listing commits {' '.join(revisions)} failed: {errors}")
+    if commits > len(changeids):
+        LOGGER.debug(f"{commits - len(changeids)} of {commits} commit(s) have no Change-Id or share one")
+    return list(changeids)
 
 
 @log_decorator
-def mark_as_public(rest, changeid, message=None):
-    payload = None
-    if message:
-        payload = {"message": message}
-
-    try:
-        return rest.post(f"/changes/{changeid}/private.delete", data=payload)
-    except requests.exceptions.HTTPError as e:
-        LOGGER.debug(f"HTTP Error Occured: {str(e)}")
-        if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({changeid}) cannot be found on remote gerrit server.")
-
-
-@log_decorator
-def mark_as_private(rest, changeid, message=None):
-    payload = None
-    if message:
-        payload = {"message": message}
-
+def get_changes_submitted_together(rest, changeid):
     try:
-        return rest.post(f"/changes/{changeid}/private", data=payload)
+        return rest.get(f"/changes/{changeid}/revisions/current/related")
     except requests.exceptions.HTTPError as e:
         LOGGER.debug(f"HTTP Error Occured: {str(e)}")
         if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({changeid}) cannot be found on remote gerrit server.")
+            raise http_error(e, changeid)
 
 
 @log_decorator
-def mark_as_ready_for_review(rest, changeid, message=None):
-    payload = None
-    if message:
-        payload = {"message": message}
-
+def query_changes(rest, query, fields=None, page_size=QUERY_PAGE_SIZE, cached=True):
+    """Yields changes matching the query page by page.
+
+    Next page is fetched in the background while the caller processes current one, so at most two pages are in
+    memory no matter how many changes match the query. Pages are fetched by offset, so callers that change the
+    matching changes (their status or last update, which orders the results) must read all pages before the first
+    change, otherwise changes moving between pages are skipped or seen twice.
+    """
+
+    def fetch(start):
+        endpoint = f"/changes/?q={quote(query, safe='')}&n={page_size}&S={start}"
+        endpoint += "".join(f"&o={option}" for option in options_for_fields(fields))
+        try:
+            return rest.get(endpoint, cached=cached)
+        except requests.exceptions.HTTPError as e:
+            LOGGER.debug(f"HTTP Error Occured: {str(e)}")
+            raise RuntimeError(f"Query ({query}) failed on remote gerrit server: {e.response.text.strip()}")
+
+    start = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(fetch, start)
+        while pending:
+            page = pending.result()
+            pending = None
+            if page and page[-1].get("_more_changes"):
+                start += len(page)
+                pending = executor.submit(fetch, start)
+            yield from page
+
+
+def search_term(change):
+    """Search term matching the change given with any identifier REST api accepts: Change-Id, number,
+    project~number or project~branch~Change-Id, url encoded or not"""
+    parts = unquote(change).split("~")
+    if len(parts) == 2 and parts[1].isdigit():
+        return f"change:{parts[1]}"
+    if len(parts) == 3:
+        return f'(project:"{parts[0]}" branch:"{parts[1]}" change:{parts[2]})'
+    return f"change:{change}"
+
+
+def query_changes_by_id(rest, changes, fields=None, cached=True):
+    """Yields given changes using as few queries as possible"""
+    changes = list(changes)
+    for idx in range(0, len(changes), QUERY_CHUNK_SIZE):
+        chunk = changes[idx : idx + QUERY_CHUNK_SIZE]
+        yield from query_changes(rest, " OR ".join(search_term(change) for change in chunk), fields, cached=cached)
+
+
+def tracking_branch(git_repo):
+    """Remote reference the checked out branch tracks, None when HEAD is detached or the branch tracks nothing"""
     try:
-        return rest.post(f"/changes/{changeid}/ready", data=payload)
-    except requests.exceptions.HTTPError as e:
-        LOGGER.debug(f"HTTP Error Occured: {str(e)}")
-        if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({changeid}) cannot be found on remote gerrit server.")
+        return git_repo.active_branch.tracking_branch()
+    except TypeError:
+        return None
+
+
+def upstream_branch(git_repo):
+    """Name of the remote branch the checked out branch tracks, None when it is not known"""
+    tracking = tracking_branch(git_repo)
+    return tracking.remote_head if tracking else None
+
+
+def drop_cherry_picks(changes, args):
+    """Keeps one change of every Change-Id. Change-Id is shared by cherry-picks of the change on other branches and
+    projects, of those the change on the upstream branch of the checked out branch is the target"""
+    by_changeid = {}
+    for change in changes:
+        by_changeid.setdefault(change["change_id"], []).append(change)
+    targets = []
+    for changeid, candidates in by_changeid.items():
+        if len(candidates) > 1:
+            branch = upstream_branch(args.git_repo) if args.git_repo.git_dir else None
+            matching = [change for change in candidates if change["branch"] == branch]
+            if len(matching) != 1:
+                found = ", ".join(f"{change['project']}~{change['branch']}" for change in candidates)
+                raise RuntimeError(
+                    f"Change-Id {changeid} is used by changes in {found}, select one with --changeid project~branch~{changeid}"
+                )
+            candidates = matching
+        targets.append(candidates[0])
+    return targets
+
+
+def get_target_changes(rest, args, fields=None, cached=True):
+    """Fetches all target changes with as few queries as possible. Chains are returned in chain order. Without
+    cached, responses are neither looked up from nor stored into the caches, which plans need as they skip requests
+    based on the state they read, and the state may have been changed outside of git-gerrit since it was cached"""
+    if args.query:
+        return query_changes(rest, args.query, fields, cached=cached)
+    chain = args.commit_chain or [args.changeid]
+    # chain members are looked up by their numbers, which unlike Change-Ids are unique
+    chain_ids = [args.change_numbers.get(changeid, changeid) for changeid in chain]
+    changes = query_changes_by_id(rest, chain_ids, fields, cached=cached)
+    order = {changeid: idx for idx, changeid in enumerate(chain)}
+    return sorted(drop_cherry_picks(changes, args), key=lambda change: order.get(change["change_id"], len(order)))
 
 
-@log_decorator
-def mark_as_work_in_progress(rest, changeid, message=None):
-    payload = None
-    if message:
-        payload = {"message": message}
+def get_targets(rest, args):
+    """Returns iterable of changes the command operates on: query results, commit chain or single change"""
+    if args.query:
+        return (change["id"] for change in query_changes(rest, args.query))
+    return args.commit_chain or [args.changeid]
 
-    try:
-        return rest.post(f"/changes/{changeid}/wip", data=payload)
-    except requests.exceptions.HTTPError as e:
-        LOGGER.debug(f"HTTP Error Occured: {str(e)}")
-        if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({changeid}) cannot be found on remote gerrit server.")
 
-
-@log_decorator
-def get_changes_submitted_together(rest, changeid):
-    try:
-        return rest.get(f"/changes/{changeid}/revisions/current/related")
-    except requests.exceptions.HTTPError as e:
-        LOGGER.debug(f"HTTP Error Occured: {str(e)}")
-        if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({changeid}) cannot be found on remote gerrit server.")
+def get_json_sem_hash(item):
+    """Stable hash of json serializable item, independent of key order"""
+    return hashlib.sha1(codec.dumps(item, sort_keys=True)).hexdigest()
 
 
 def _get_payload(payload_json, keep_labels, path_prefixes, robot_id):
+    """Reads review payload, turning its comments into RobotComments of paths relative to repository root"""
+
     def trim_prefixes(name, prefixes):
         for prefix in prefixes:
-            name = name.lstrip(prefix)
+            if name.startswith(prefix):
+                name = name[len(prefix) :]
+                break
         return name.replace(ntpath.sep, "/")
 
     if not path_prefixes:
         path_prefixes = []
     payload = None
-    prefixes = sorted(path_prefixes, key=len)
+    # longest matching prefix is removed
+    prefixes = sorted(path_prefixes, key=len, reverse=True)
     regex = re.compile(r"^(?P<prio>\[.*?\]) .*:\d+:\d+: (?P<msg>.*)$", re.MULTILINE)
     if not payload_json.exists():
         LOGGER.error(f"Payload json {payload_json} doesn't exists")
         sys.exit(1)
 
-    with payload_json.open() as f:
-        payload = json.load(f)
+    def to_robot_comment(comment):
+        res = regex.match(comment.message)
+        comment.message = sys.intern(f"{res.group('prio')} {res.group('msg')}" if res else comment.message)
+        comment.robot_id = robot_id
+        comment.robot_run_id = None
+        comment.robot_run_id = get_json_sem_hash(comment.to_json())[0:8]
+        return comment
+
+    payload = load_review_input(payload_json.read_text(encoding="utf-8"), to_robot_comment)
+    if not isinstance(payload, dict) or "comments" not in payload:
+        raise RuntimeError(f"Payload json {payload_json} has no comments")
 
     if not keep_labels and "labels" in payload:
         del payload["labels"]
 
-    comments = payload["comments"].copy()
-    payload["robot_comments"] = {}
-    for key in comments:
-        new_key = trim_prefixes(key, prefixes)
-        for item in comments[key]:
-            item["robot_id"] = "clang-tidy"
-            res = regex.match(item["message"])
-            if res:
-                item["message"] = f"{res.group('prio')} {res.group('msg')}"
-            item["robot_id"] = robot_id
-            item["robot_run_id"] = get_json_sem_hash(item)[0:8]
-
-        payload["robot_comments"][new_key] = comments[key].copy()
-
-    del payload["comments"]
-
-    LOGGER.debug(json.dumps(payload, indent=4))
+    comments = payload.pop("comments")
+    robot_comments = payload["robot_comments"] = {}
+    duplicates = 0
+    for key, key_comments in comments.items():
+        file_comments = robot_comments.setdefault(trim_prefixes(key, prefixes), [])
+        # several keys can trim into the same path, comments of earlier ones are already there
+        seen = {comment.key() for comment in file_comments}
+        for comment in key_comments:
+            if comment.key() in seen:
+                duplicates += 1
+                continue
+            seen.add(comment.key())
+            file_comments.append(comment)
+    if duplicates:
+        LOGGER.info(f"Skipped {duplicates} duplicate comment(s) in {payload_json}")
+
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug(json.dumps(payload, indent=4, default=codec.json_default))
     return payload
 
+
 def get_robot_comments(rest, change, revision):
     try:
         return rest.get(f"/changes/{change}/revisions/{revision}/robotcomments")
     except requests.exceptions.HTTPError as e:
         LOGGER.debug(f"HTTP Error Occured: {str(e)}")
         if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({change}) cannot be found on remote gerrit server.")  # TODO: provide more meaningful error message
+            raise http_error(e, change)
 
-@log_decorator
-def review(rest, git_repo, args, gerrit_config):
-    def get_rev(details):
-        rev = 1
-        for commit in details["revisions"]:
-            rev_in = details["revisions"][commit]["_number"]
-            if rev_in > rev:
-                rev = rev_in
-        return rev
-
-    change_details = get_change_detail(rest, args.changeid)
-    rev = get_rev(change_details)
-    payload = _get_payload(args.payload, args.path_prefixes, args.keep_labels, args.robot_id)
-    payload["omit_duplicate_comments"] = True
-    payload["notify"] = args.notify
 
+def post_review(rest, change, revision, payload):
     try:
-        return rest.post(f"/changes/{args.changeid}/revisions/{rev}/review", data=payload)
+        return rest.post(f"/changes/{change}/revisions/{revision}/review", data=payload)
     except requests.exceptions.HTTPError as e:
         LOGGER.debug(f"HTTP Error Occured: {str(e)}")
         LOGGER.warning(e.response.text)
         if e.response.status_code != 409:
-            raise RuntimeError(f"Provided change ({args.changeid}) cannot be found on remote gerrit server.")
+            raise http_error(e, change)
 
 
 @log_decorator
-def main():
-    git_repo = get_git_root()
-    git_config = git_repo.config_reader()
+def review(rest, git_repo, args, gerrit_config):
+    if args.query or args.commits:
+        raise RuntimeError("review cannot be used with --query or --commits, payload is always sent to a single change")
+    if args.dry_run:
+        raise RuntimeError("review does not support --dry-run")
+    rev = args.revision or "current"
+    payload = _get_payload(args.payload, args.keep_labels, args.path_prefixes, args.robot_id)
+    payload["omit_duplicate_comments"] = True
+    payload["notify"] = args.notify
+
+    if args.base_revision:
+        # chains are posted to local commits, single change to the exact patch set comments are moved to
+        if args.commit_chain:
+            target = args.commit or "HEAD"
+        else:
+            rev = target = local_revision(git_repo, get_change_detail(rest, args.changeid, fields=["current_revision"]))
+        comments = payload["robot_comments"]
+        payload["robot_comments"] = remap_comments(git_repo.working_tree_dir, args.base_revision, target, comments)
+
+    if args.commit_chain:
+        return review_chain(rest, git_repo, args, payload)
+    return post_review(rest, args.changeid, rev, payload)
+
+
+def local_revision(git_repo, change):
+    """Returns commit of the current patch set of the change, fetching it when it is not available locally"""
+    revision = change["current_revision"]
+    exists = subprocess.run(
+        ["git", "cat-file", "-e", f"{revision}^{{commit}}"], cwd=git_repo.working_tree_dir, stderr=subprocess.DEVNULL
+    )
+    if exists.returncode != 0:
+        try:
+            tracking = git_repo.active_branch.tracking_branch()
+        except TypeError:
+            tracking = None  # detached HEAD, like in ci jobs
+        remote = tracking.remote_name if tracking else "origin"
+        ref = change["revisions"][revision]["ref"]
+        LOGGER.info(f"Fetching {ref} from {remote}")
+        fetch = subprocess.run(
+            ["git", "fetch", remote, ref], cwd=git_repo.working_tree_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if fetch.returncode != 0:
+            raise RuntimeError(f"Fetching {ref} from {remote} failed: {fetch.stderr.decode('utf-8', 'replace').strip()}")
+    return revision
+
+
+@log_decorator
+def review_chain(rest, git_repo, args, payload):
+    """Posts comments of the payload to the changes of the chain that introduced the commented lines, concurrently.
+
+    Reviews are posted to the local commits, as line numbers are only valid for the patch sets that were analysed.
+    Changes without comments are left alone.
+    """
+    commits = chain_commits(git_repo.working_tree_dir, args.commit or "HEAD", args.commit_chain)
+    if not commits:
+        raise RuntimeError(f"{args.commit or 'HEAD'} is not a commit of the chain of {args.changeid}")
+    routed = route_comments(git_repo.working_tree_dir, commits, payload.pop("robot_comments"))
+    reviews = [(commit, change, routed[commit]) for commit, change in commits if commit in routed]
+    LOGGER.info(f"Posting review comments into {len(reviews)} of {len(commits)} change(s) in the chain")
+
+    def post(commit, change, comments):
+        post_review(rest, change, commit, dict(payload, robot_comments=comments))
+
+    failures = 0
+    rest.resize_pool(REPO_WORKERS)
+    with Progress(rest, len(reviews)) as progress, ThreadPoolExecutor(max_workers=REPO_WORKERS) as executor:
+        futures = {executor.submit(post, *review): review for review in reviews}
+        for future in as_completed(futures):
+            commit, change, comments = futures[future]
+            count = sum(len(path_comments) for path_comments in comments.values())
+            status = "ok"
+            try:
+                future.result()
+            except RuntimeError as e:
+                LOGGER.error(str(e))
+                status = "failed"
+                failures += 1
+            args.output.emit(
+                "review",
+                {"change": change, "commit": commit, "comments": count, "status": status},
+                f" * {change}: {count} comment(s) {'posted' if status == 'ok' else 'FAILED'}",
+            )
+            progress.advance()
+    if failures:
+        raise RuntimeError(f"Posting review failed on {failures} change(s)")
+
+
+def push_options(topic=None, hashtags=None, wip=False, ready=False, private=False, remove_private=False, reviewers=None):
+    """Gerrit push options that set topic, hashtags, state and reviewers of the uploaded changes"""
+    options = [f"topic={topic}"] if topic else []
+    options += [f"hashtag={tag}" for tag in hashtags or []]
+    for option, enabled in (("wip", wip), ("ready", ready), ("private", private), ("remove-private", remove_private)):
+        if enabled:
+            options.append(option)
+    options += [f"r={reviewer}" for reviewer in reviewers or []]
+    return options
+
+
+def _push_target(git_repo, args):
+    """Returns (remote, branch) to push into, from arguments or from upstream of current branch"""
+    tracking = tracking_branch(git_repo)
+    remote = args.remote or (tracking.remote_name if tracking else "origin")
+    branch = args.branch or (tracking.remote_head if tracking else "master")
+    return remote, branch
+
+
+@log_decorator
+def push(rest, git_repo, args, gerrit_config):
+    """Uploads HEAD (or --commit) for review with push options, so that no REST requests are needed afterwards"""
+    from git import GitCommandError
+
+    if args.query or args.changeid:
+        raise RuntimeError("push uploads local commits, use --commit instead of --changeid or --query")
+    head = args.commit or "HEAD"
+    remote, branch = _push_target(git_repo, args)
     try:
-        gerrit_config = get_gerrit_configuration(git_config)
-    except RuntimeError as e:
-        LOGGER.error(str(e))
-        sys.exit(1)
-    args = parse_args(gerrit_config)
-    rest = get_gerrit_api(gerrit_config)
+        hashtags = args.hashtags or [git_repo.active_branch.name]
+    except TypeError:
+        hashtags = []  # detached HEAD has no branch name to use
+    state = dict(
+        wip=args.wip, ready=args.ready, private=args.private, remove_private=args.remove_private, reviewers=args.reviewers
+    )
+    pushes = []
+    if args.support_chain:
+        try:
+            commits = int(git_repo.git.rev_list("--count", f"{remote}/{branch}..{head}"))
+        except GitCommandError:
+            commits = 1  # target branch is not known locally, push everything at once
+        if commits > 1:
+            # parents go first, HEAD push then only touches HEAD and leaves parents with the topic ci does not build
+            pushes.append((f"{head}~1", push_options(gerrit_config["prevent_build_topic"], hashtags, **state)))
+    pushes.append((head, push_options(args.topic, hashtags, **state)))
+
+    LOGGER.info(f"Pushing for review into {remote} {branch}:")
+    for revision, options in pushes:
+        command = [f"--push-option={option}" for option in options] + [remote, f"{revision}:refs/for/{branch}"]
+        LOGGER.info(f" * git push {' '.join(shlex.quote(part) for part in command)}")
+        if args.dry_run:
+            continue
+        process = subprocess.run(
+            ["git", "push"] + command, cwd=git_repo.working_tree_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        # gerrit reports created changes and rejections as remote messages on stderr
+        output = process.stderr.decode("utf-8", "replace").strip()
+        if process.returncode != 0 and revision != head and "(no new changes)" in output:
+            # only HEAD was amended, parents are already up to date in gerrit
+            LOGGER.info(f" * {revision} has no new changes")
+            continue
+        if process.returncode != 0:
+            raise RuntimeError(f"Push into {remote} failed: {output}")
+        for line in output.splitlines():
+            LOGGER.info(line.rstrip())
+
+
+class Session:
+    """Keeps git repositories, configurations and gerrit connections around between invocations"""
+
+    def __init__(self, cache_ttl=0):
+        self.cache_ttl = cache_ttl
+        self._repos = {}
+        self._apis = {}
+
+    def git_repo(self):
+        key = (str(Path.cwd()), os.environ.get("WORKSPACE"))
+        if key not in self._repos:
+            self._repos[key] = get_git_root()
+        return self._repos[key]
+
+    def gerrit_config(self, git_repo):
+        # git config section is memoized on config file modification times, so this is cheap and never stale
+        return get_gerrit_configuration(git_repo)
+
+    def gerrit_api(self, gerrit_config):
+        key = (gerrit_config["host"], gerrit_config["user"], gerrit_config["token"])
+        if key not in self._apis:
+            self._apis[key] = get_gerrit_api(gerrit_config, cache_ttl=self.cache_ttl)
+        return self._apis[key]
+
+
+def ci_change():
+    """Returns (change, patch set) that triggered the ci job according to Gerrit Trigger environment variables.
+    Change is the url encoded project~number used in REST endpoints, see search_term for queries"""
+    number = os.environ.get("GERRIT_CHANGE_NUMBER")
+    project = os.environ.get("GERRIT_PROJECT")
+    if not number or not project:
+        return None, None
+    return f"{quote(project, safe='')}~{number}", os.environ.get("GERRIT_PATCHSET_NUMBER") or None
+
+
+@log_decorator
+def resolve_targets(rest, git_repo, args, use_ci_env=True):
+    """Resolves changeid and commit chain to operate on from --commit, --changeid, ci environment, HEAD and --support-chain
+
+    revision is set only when exact patch set is known from ci environment, "current" is used otherwise. Without
+    use_ci_env, like for every repository of --repos, ci environment is ignored and HEAD is used.
+    """
     args.commit_chain = None
+    args.change_numbers = {}
+    args.revision = None
+    if args.query:
+        return
+    if args.commits:
+        args.commit_chain = get_changeids_of_commits(git_repo, [args.commits])
+        if not args.commit_chain:
+            raise RuntimeError(f"No commits with Change-Id in {args.commits}")
+        LOGGER.info(f"Found {len(args.commit_chain)} change(s) in {args.commits}")
+        args.changeid = args.commit_chain[0]
+        return
+
+    if use_ci_env and not args.changeid and not args.commit:
+        args.changeid, args.revision = ci_change()
+        if args.changeid:
+            LOGGER.debug(f"Using change {args.changeid} patch set {args.revision} from ci environment")
+
     if args.commit:
         LOGGER.debug("commit specified, reading changeid")
         args.changeid = get_changeid_of_commit(git_repo, args.commit)
@@ -570,18 +1074,253 @@ def main():
     if not args.changeid:
         LOGGER.debug("change id is not set, reading changing from HEAD")
         args.changeid = get_changeid_of_commit(git_repo, git_repo.head.commit.hexsha)
+    if not args.changeid:
+        raise RuntimeError(f"No Change-Id found in {args.commit or 'HEAD'} of {git_repo.working_tree_dir}")
 
     if args.support_chain:
         response = get_changes_submitted_together(rest, args.changeid)
         if response["changes"]:
             args.commit_chain = list(map(lambda change: change["change_id"], response["changes"]))
+            args.change_numbers = {
+                change["change_id"]: f"{quote(change['project'], safe='')}~{change['_change_number']}"
+                for change in response["changes"]
+                if "_change_number" in change
+            }
             LOGGER.debug(
                 f"Due to commit chains support, changeid ({args.changeid}) is switched to top of the commit chain ({args.commit_chain[0]})"
             )
             LOGGER.debug(args.commit_chain)
             args.changeid = args.commit_chain[0]
+            args.revision = None
+
+
+def _target_options(args):
+    return (args.changeid, args.commit, args.query, args.support_chain, args.commits)
+
+
+def execute(rest, git_repo, args, gerrit_config):
+    """Executes the command selected in args and logs it as an event. Returns True on success"""
+    set_log_context(command=args.cmd.__name__)
+    started = time.perf_counter()
+    throttled = rest.throttled_seconds
+    status = "failed"
+    # batch and --repos share one output between their commands
+    owns_output = getattr(args, "output", None) is None
+    if owns_output:
+        args.output = Output(args.output_format)
     try:
         args.cmd(rest, git_repo, args, gerrit_config)
+        status = "ok"
+    except RuntimeError as e:
+        LOGGER.error(str(e))
+    finally:
+        if owns_output:
+            args.output.close()
+        if rest.change_ids:
+            rest.change_ids.save()
+        throttled = rest.throttled_seconds - throttled
+        if throttled:
+            LOGGER.info(f"Spent {throttled:.1f}s waiting for gerrit rate limits")
+        if rest.shared_cache:
+            LOGGER.debug(f"Shared cache: {rest.shared_cache.hits} hit(s), {rest.shared_cache.misses} miss(es)")
+        duration = round(time.perf_counter() - started, 4)
+        log_event(f"{args.cmd.__name__} {status}", change=args.changeid, status=status, duration=duration)
+        set_log_context(command=None)
+    return status == "ok"
+
+
+@log_decorator
+def run(argv, session):
+    """Executes single git-gerrit invocation with given command line arguments"""
+    git_repo = session.git_repo()
+    try:
+        gerrit_config = session.gerrit_config(git_repo)
     except RuntimeError as e:
         LOGGER.error(str(e))
         sys.exit(1)
+    args = parse_args(gerrit_config, argv)
+    args.session = session
+    args.target_options = _target_options(args)
+    args.git_repo = git_repo
+    rest = session.gerrit_api(gerrit_config)
+    args.commit_chain = None
+    args.change_numbers = {}
+    args.requests_before = rest.requests_sent
+    if args.repos:
+        if not run_repositories(rest, args, gerrit_config):
+            sys.exit(1)
+        return
+    if args.resolve_targets:
+        try:
+            resolve_targets(rest, git_repo, args)
+        except RuntimeError as e:
+            LOGGER.error(str(e))
+            sys.exit(1)
+
+    if not execute(rest, git_repo, args, gerrit_config):
+        sys.exit(1)
+
+
+FUSABLE_COMMANDS = (prepare, hashtag, topic, workinprogress, readyforreview, makeprivate, makepublic, abandon)
+
+
+@log_decorator
+def run_repositories(rest, args, gerrit_config):
+    """Runs the command in every repository of --repos in parallel over one gerrit connection pool. Returns True
+    when it succeeded everywhere"""
+    try:
+        if args.query or args.changeid:
+            raise RuntimeError("--repos works on HEAD (or --commit) of every repository, not with --changeid or --query")
+        if args.cmd in (batch, daemon):
+            raise RuntimeError(f"{args.cmd.__name__} cannot be used with --repos")
+        repositories = find_repositories(args.repos)
+        if not repositories:
+            raise RuntimeError(f"No git repositories found from {args.repos}")
+    except RuntimeError as e:
+        LOGGER.error(str(e))
+        return False
+
+    def run_in(path):
+        repo_args = copy.copy(args)
+        repo_args.git_repo = LazyRepo([Path(path)])
+        try:
+            if repo_args.resolve_targets:
+                # ci change belongs to one repository at most, every repository works on its own HEAD
+                resolve_targets(rest, repo_args.git_repo, repo_args, use_ci_env=False)
+            return execute(rest, repo_args.git_repo, repo_args, gerrit_config)
+        except RuntimeError as e:
+            LOGGER.error(f"{path}: {e}")
+            return False
+        finally:
+            progress.advance()
+
+    LOGGER.info(f"Running {args.cmd.__name__} in {len(repositories)} repositories")
+    rest.resize_pool(REPO_WORKERS)
+    args.output = Output(args.output_format)
+    try:
+        with Progress(rest, len(repositories), "repositories") as progress:
+            with ThreadPoolExecutor(max_workers=REPO_WORKERS) as executor:
+                results = list(executor.map(run_in, repositories))
+
+        LOGGER.info("Results:")
+        for path, ok in zip(repositories, results):
+            status = "ok" if ok else "failed"
+            args.output.emit("repository", {"repository": path, "status": status}, f" * {path}: {'ok' if ok else 'FAILED'}")
+    finally:
+        args.output.close()
+    failures = results.count(False)
+    if failures:
+        LOGGER.error(f"{failures} of {len(repositories)} repositories failed")
+    return not failures
+
+
+def _read_batch_script(script):
+    """Yields (line number, line) pairs of commands in the batch script, skipping empty lines and comments"""
+    stream = sys.stdin if str(script) == "-" else script.open()
+    with stream:
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield number, line
+
+
+def _batch_argv(line):
+    """Batch script lines are either json arrays or shell quoted arguments"""
+    if line.startswith("["):
+        return json.loads(line)
+    return shlex.split(line)
+
+
+@log_decorator
+def batch(rest, git_repo, args, gerrit_config):
+    """Runs every command of the batch script over one session, git repository and configuration"""
+    resolved = {}
+    pending = [] if args.fuse else None
+    failures = 0
+    for number, line in _read_batch_script(args.script):
+        ok = False
+        try:
+            argv = _batch_argv(line)
+            if {"batch", "daemon"} & set(argv):
+                raise RuntimeError("batch and daemon commands cannot be used inside a batch")
+            line_args = parse_args(gerrit_config, argv, configure_logging_from_args=False)
+            line_args.session = args.session
+            line_args.dry_run = line_args.dry_run or args.dry_run
+            line_args.resume = line_args.resume or args.resume
+            line_args.git_repo = args.git_repo
+            line_args.output = args.output
+            line_args.requests_before = rest.requests_sent
+            options = _target_options(line_args)
+            if options == (None, None, None, False, None):
+                # no targets on the line itself, operate on the targets of the batch
+                options = args.target_options
+                line_args.changeid, line_args.commit, line_args.query, line_args.support_chain, line_args.commits = options
+            if options not in resolved:
+                resolve_targets(rest, git_repo, line_args)
+                resolved[options] = (line_args.changeid, line_args.commit_chain, line_args.change_numbers, line_args.revision)
+            line_args.changeid, line_args.commit_chain, line_args.change_numbers, line_args.revision = resolved[options]
+            line_args.target_options = options
+            if pending is not None:
+                if _only_plans(line_args):
+                    line_args.pending_operations = pending
+                else:
+                    # command reads or changes state outside of plans, earlier state changes have to be sent first
+                    _flush_pending(rest, args, pending)
+            ok = execute(rest, git_repo, line_args, gerrit_config)
+        except SystemExit as e:
+            ok = not e.code
+        except (RuntimeError, ValueError) as e:
+            LOGGER.error(str(e))
+
+        status = "ok" if ok else "failed"
+        args.output.emit(
+            "batch", {"line": number, "command": line, "status": status}, f"[{number}] {'ok' if ok else 'FAILED'}: {line}"
+        )
+        if not ok:
+            failures += 1
+            if not args.keep_going:
+                break
+
+    if pending:
+        try:
+            _flush_pending(rest, args, pending)
+        except RuntimeError as e:
+            LOGGER.error(str(e))
+            failures += 1
+
+    if failures:
+        raise RuntimeError(f"{failures} batch command(s) failed")
+
+
+def _only_plans(args):
+    """True when command only plans state changes, so that its operations can be fused with following commands"""
+    return args.cmd in FUSABLE_COMMANDS and not getattr(args, "check", False)
+
+
+def _flush_pending(rest, args, pending):
+    if not pending:
+        return
+    LOGGER.info(f"Sending fused state changes of {len(pending)} operation(s):")
+    operations = order_by_change(pending)
+    pending.clear()
+    try:
+        run_plan(rest, args, operations)
+    except RuntimeError as e:
+        raise RuntimeError(f"Sending fused state changes failed: {e}")
+
+
+@log_decorator
+def daemon(rest, git_repo, args, gerrit_config):
+    from .daemon import serve, stop_daemon
+
+    if args.stop:
+        if not stop_daemon():
+            raise RuntimeError("No git-gerrit daemon is running")
+        LOGGER.info("git-gerrit daemon stopped")
+    else:
+        serve(Session(cache_ttl=args.cache_ttl), args.idle_timeout)
+
+
+@log_decorator
+def main():
+    run(sys.argv[1:], Session())
@@ -0,0 +1,67 @@
+"""Append-only journal of completed operations.
+
+Bulk commands record every operation as soon as gerrit has accepted it, one json object per line, into
+.git/gitgerrit/. When the command is run again with --resume, operations found in the journal are skipped so that
+a run interrupted halfway only has to send the remaining requests. Journal is removed once the command completes.
+"""
+import hashlib
+import os
+from pathlib import Path
+from . import codec
+from .logger import LOGGER
+
+JOURNAL_DIR = "gitgerrit"
+
+
+def journal_name(command, target_options):
+    """Same command on same targets always uses the same journal"""
+    digest = hashlib.sha1(codec.dumps([command, list(target_options)])).hexdigest()
+    return f"{command}-{digest[:12]}"
+
+
+def _operation_key(operation):
+    payload = hashlib.sha1(operation.body()).hexdigest()[:12]
+    return f"{operation.change} {operation.action} {payload}"
+
+
+class Journal:
+    """Operations completed by earlier, interrupted run of a command and writer for the current run"""
+
+    def __init__(self, git_dir, name, resume=False):
+        self.path = Path(git_dir) / JOURNAL_DIR / f"{name}.ndjson"
+        self.completed = set()
+        self._stream = None
+        if resume:
+            self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            LOGGER.info("Nothing to resume, no journal of earlier run found")
+            return
+        with self.path.open("rb") as stream:
+            for line in stream:
+                try:
+                    self.completed.add(codec.loads(line)["key"])
+                except (ValueError, KeyError, TypeError):
+                    # last line can be partially written if process was killed
+                    LOGGER.debug(f"Ignoring malformed journal line: {line!r}")
+        LOGGER.info(f"Resuming, {len(self.completed)} operation(s) already completed")
+
+    def done(self, operation):
+        return _operation_key(operation) in self.completed
+
+    def record(self, operation):
+        if self._stream is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # resumed runs keep appending to the same journal, others start from scratch
+            self._stream = self.path.open("ab" if self.completed else "wb")
+        self._stream.write(codec.dumps({"key": _operation_key(operation), "change": operation.name}) + b"\n")
+        self._stream.flush()
+
+    def close(self, completed):
+        """Closes the journal, removing it when every operation of the command has been completed"""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if completed and self.path.exists():
+            os.remove(self.path)
@@ -1,4 +1,11 @@
+import atexit
+import json
 import logging
+import queue
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 
 LOG_LEVELS = {
     "notset": logging.NOTSET,
@@ -8,19 +15,149 @@ LOG_LEVELS = {
     "error": logging.ERROR,
     "critical": logging.CRITICAL,
 }
+LOG_FORMATS = ["text", "json"]
+EVENT_FIELDS = ("command", "change", "method", "endpoint", "duration", "status")
 _APPNAME = "git-gerrit"
-logging.basicConfig(format="[%(levelname)s]: %(message)s", level=logging.INFO)
+_TEXT_FORMATTER = logging.Formatter("[%(levelname)s]: %(message)s")
+CLEAR_LINE = "\r\x1b[K"
+# Context fields (like the command being executed) that are attached to every record
+LOG_CONTEXT = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line json object (NDJSON)"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "message": record.getMessage(),
+        }
+        for field in EVENT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry)
+
+
+class _StatusLineHandler(logging.StreamHandler):
+    """StreamHandler that keeps a status line (progress) below the records it writes"""
+
+    def __init__(self):
+        super().__init__()
+        self.status = ""
+
+    def emit(self, record):
+        # called with handler lock held, like set_status
+        if self.status:
+            self.stream.write(CLEAR_LINE)
+        super().emit(record)
+        if self.status:
+            self.stream.write(self.status)
+            self.flush()
+
+    def set_status(self, text):
+        self.acquire()
+        try:
+            self.status = text
+            self.stream.write(CLEAR_LINE + text)
+            self.flush()
+        finally:
+            self.release()
+
+
+class _ContextFilter(logging.Filter):
+    """Adds LOG_CONTEXT fields to records that do not already define them"""
+
+    def filter(self, record):
+        for key, value in LOG_CONTEXT.items():
+            if getattr(record, key, None) is None:
+                setattr(record, key, value)
+        return True
+
+
+# Records are formatted and written by a background thread so that callers never block on stderr or file writes
+_QUEUE = queue.SimpleQueue()
+_QUEUE_HANDLER = QueueHandler(_QUEUE)
+_QUEUE_HANDLER.setFormatter(logging.Formatter("%(message)s"))
+_QUEUE_HANDLER.addFilter(_ContextFilter())
+_STREAM_HANDLER = _StatusLineHandler()
+_STREAM_HANDLER.setFormatter(_TEXT_FORMATTER)
+_LISTENER = QueueListener(_QUEUE, _STREAM_HANDLER)
+_LISTENER.start()
+atexit.register(_LISTENER.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[_QUEUE_HANDLER])
 LOGGER = logging.getLogger(_APPNAME)
+_EVENT_LEVEL = logging.DEBUG
+
+
+def configure_logging(level, log_format="text"):
+    """Sets log level and output format ("text" or "json") of the application logger"""
+    global _EVENT_LEVEL
+    LOGGER.setLevel(LOG_LEVELS[level])
+    if log_format == "json":
+        _STREAM_HANDLER.setFormatter(JsonFormatter())
+        # structured events are the whole point of json output, so they are visible on default log level
+        _EVENT_LEVEL = logging.INFO
+    else:
+        _STREAM_HANDLER.setFormatter(_TEXT_FORMATTER)
+        _EVENT_LEVEL = logging.DEBUG
+
+
+def set_log_context(**fields):
+    """Sets or clears (value None) fields that are attached to every following log record"""
+    for key, value in fields.items():
+        if value is None:
+            LOG_CONTEXT.pop(key, None)
+        else:
+            LOG_CONTEXT[key] = value
+
+
+def log_event(message, **fields):
+    """Logs a structured event, fields should be a subset of EVENT_FIELDS"""
+    if LOGGER.isEnabledFor(_EVENT_LEVEL):
+        LOGGER.log(_EVENT_LEVEL, message, extra=fields)
+
+
+def status_line_enabled():
+    """Status line is shown only below text logs written into a terminal"""
+    stream = _STREAM_HANDLER.stream
+    return _STREAM_HANDLER.formatter is _TEXT_FORMATTER and hasattr(stream, "isatty") and stream.isatty()
+
+
+def set_status_line(text):
+    """Shows text below log records until replaced, empty text removes the status line"""
+    _STREAM_HANDLER.set_status(text)
+
+
+@contextmanager
+def log_stream(stream):
+    """Temporarily writes all log output into given stream instead of stderr"""
+    _LISTENER.stop()
+    original = _STREAM_HANDLER.setStream(stream)
+    _LISTENER.start()
+    try:
+        yield
+    finally:
+        # stopping the listener drains the queue so that nothing is written to the stream after returning
+        _LISTENER.stop()
+        _STREAM_HANDLER.setStream(original)
+        _LISTENER.start()
 
 
 def log_decorator(wrapped):
     """Decorator helper that logs function calls"""
 
     def log_enter_exit(*args, **kwargs):
-        arguments = ""
-        LOGGER.debug("{}({}) [ENTERING]".format(wrapped.__name__, arguments))
+        if not LOGGER.isEnabledFor(logging.DEBUG):
+            return wrapped(*args, **kwargs)
+        LOGGER.debug("{}() [ENTERING]".format(wrapped.__name__))
+        started = time.perf_counter()
         result = wrapped(*args, **kwargs)
-        LOGGER.debug("{}() [LEAVING]".format(wrapped.__name__))
+        LOGGER.debug("{}() [LEAVING]".format(wrapped.__name__), extra={"duration": round(time.perf_counter() - started, 4)})
         return result  # noqa: R504
 
+    log_enter_exit.__name__ = wrapped.__name__
+    log_enter_exit.__doc__ = wrapped.__doc__
     return log_enter_exit
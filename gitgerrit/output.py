@@ -0,0 +1,72 @@
+"""Result records of commands.
+
+Commands emit one typed record (a json serializable dict with "type" key) per result as soon as the result is known.
+Depending on --format, records are written into stdout as json lines (ndjson), as one json array that is written
+element by element (json) or as aligned tables, one per record type (table). Default text format keeps the human
+readable lines in the log. Only tables, which need every row to align columns, keep records in memory.
+"""
+import sys
+import threading
+from . import codec
+from .logger import LOGGER
+
+OUTPUT_FORMATS = ["text", "json", "ndjson", "table"]
+
+
+class Output:
+    """Writes records of one command (or batch) in the requested format. Thread safe"""
+
+    def __init__(self, output_format="text", stream=None):
+        self.format = output_format
+        self.stream = stream or sys.stdout
+        self._tables = {}
+        self._records = 0
+        self._lock = threading.Lock()
+
+    def emit(self, kind, record, text=None, cells=None):
+        """Outputs a record of given type. text is the log line of text format, records without one are shown as a
+        table. cells overrides how the record is shown in tables"""
+        with self._lock:
+            record = dict(type=kind, **record)
+            if self.format == "ndjson":
+                self.stream.write(codec.dumps(record).decode("utf-8") + "\n")
+                self.stream.flush()
+            elif self.format == "json":
+                self.stream.write(("[\n" if not self._records else ",\n") + codec.dumps(record).decode("utf-8"))
+                self.stream.flush()
+            elif self.format == "table" or text is None:
+                row = cells or {key: _cell(value) for key, value in record.items() if key != "type"}
+                self._tables.setdefault(kind, []).append(row)
+            else:
+                LOGGER.info(text)
+            self._records += 1
+
+    def close(self):
+        """Finishes json array and writes tables"""
+        with self._lock:
+            if self.format == "json":
+                self.stream.write("\n]\n" if self._records else "[]\n")
+                self.stream.flush()
+            write = LOGGER.info if self.format == "text" else lambda line: self.stream.write(line + "\n")
+            for rows in self._tables.values():
+                for line in _table(rows):
+                    write(line)
+            self._tables = {}
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ", ".join(_cell(item) for item in value)
+    if isinstance(value, dict):
+        return codec.dumps(value).decode("utf-8")
+    return str(value)
+
+
+def _table(rows):
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    rows = [dict(zip(columns, columns))] + rows
+    widths = {column: max(len(row.get(column, "")) for row in rows) for column in columns}
+    for row in rows:
+        yield "  ".join(row.get(column, "").ljust(widths[column]) for column in columns).rstrip()
@@ -0,0 +1,268 @@
+"""Planning of state changing requests.
+
+Commands that modify changes describe the requests they need as Operations, built from the current state of the
+changes. Operations of each change are fused into as few requests as possible and the ones that would not change
+anything are kept in the plan as no-ops so that they can be reported. The very same plan is either printed
+(--dry-run) or executed, so planning and execution never diverge.
+"""
+from collections import namedtuple
+from itertools import groupby
+import requests
+from . import codec
+from .client import http_error
+from .journal import Journal, journal_name
+from .logger import LOGGER
+from .output import Output
+from .progress import Progress
+
+# action: (http method, endpoint template)
+ACTIONS = {
+    "hashtags": ("POST", "/changes/{change}/hashtags"),
+    "topic": ("PUT", "/changes/{change}/topic"),
+    "public": ("POST", "/changes/{change}/private.delete"),
+    "private": ("POST", "/changes/{change}/private"),
+    "ready": ("POST", "/changes/{change}/ready"),
+    "wip": ("POST", "/changes/{change}/wip"),
+    "abandon": ("POST", "/changes/{change}/abandon"),
+}
+# Rough size of request line and headers, including authorization, of a single request
+REQUEST_OVERHEAD_BYTES = 350
+JOURNALED = "completed by earlier run"
+# action: (ChangeInfo field it sets, value it sets the field to)
+STATE_FIELDS = {
+    "wip": ("work_in_progress", True),
+    "ready": ("work_in_progress", False),
+    "private": ("is_private", True),
+    "public": ("is_private", False),
+}
+NOOP_REASONS = {
+    "wip": "already work in progress",
+    "ready": "already ready for review",
+    "private": "already private",
+    "public": "already public",
+}
+
+
+class Operation(namedtuple("Operation", ["change", "name", "action", "payload", "noop", "state"])):
+    """Single state changing request. change is the identifier used in the endpoint, name is for humans, noop
+    holds the reason why the request does not need to be sent and state is the ChangeInfo it was planned from"""
+
+    __slots__ = ()
+
+    @property
+    def method(self):
+        return ACTIONS[self.action][0]
+
+    @property
+    def endpoint(self):
+        return ACTIONS[self.action][1].format(change=self.change)
+
+    def body(self):
+        return codec.dumps(self.payload) if self.payload is not None else b""
+
+    def describe(self, noop=None):
+        noop = noop or self.noop
+        description = f"{self.name}: {self.action}"
+        if self.payload:
+            description += f" {self.body().decode('utf-8')}"
+        if noop:
+            description += f" (skipped, {noop})"
+        return description
+
+    def record(self, noop=None, status="sent"):
+        """Result record of the operation, status is skipped for no-ops"""
+        noop = noop or self.noop
+        return {
+            "change": self.name,
+            "action": self.action,
+            "payload": self.payload,
+            "status": "skipped" if noop else status,
+            "reason": noop,
+        }
+
+
+def _operation(change, action, payload=None, noop=None):
+    return Operation(change["id"], change["change_id"], action, payload, noop, change)
+
+
+def _message_payload(message):
+    return {"message": message} if message else None
+
+
+def plan_state(changes, action, message=None):
+    """Operations for wip, ready, private, public and abandon"""
+    for change in changes:
+        yield _operation(change, action, _message_payload(message))
+
+
+def plan_hashtags(changes, adds=None, removes=None):
+    for change in changes:
+        yield _operation(change, "hashtags", {"add": list(adds or []), "remove": list(removes or [])})
+
+
+def plan_topic(changes, topic):
+    for change in changes:
+        yield _operation(change, "topic", {"topic": topic})
+
+
+def plan_prepare(changes, prevent_build_topic, is_chain):
+    """First change of a chain is its HEAD. Without chain, every change is prepared as its own HEAD"""
+    head_topic = None
+    for idx, change in enumerate(changes):
+        if idx == 0 or not is_chain:
+            head_topic = change.get("topic")
+        if head_topic:
+            yield from plan_hashtags([change], adds=[head_topic])
+        else:
+            yield _operation(change, "hashtags", None, "HEAD has no topic to use as hashtag")
+        yield from plan_state([change], "public")
+        yield from plan_state([change], "ready")
+        if is_chain and idx > 0:
+            yield from plan_topic([change], prevent_build_topic)
+
+
+def order_by_change(operations):
+    """Sorts operations so that operations of each change are consecutive, keeping their relative order"""
+    order = {}
+    for operation in operations:
+        order.setdefault(operation.change, len(order))
+    return sorted(operations, key=lambda operation: order[operation.change])
+
+
+def fuse(operations):
+    """Merges consecutive operations of each change into fewest possible requests.
+
+    Every operation is compared against the state the change had when it was planned and the ones that would not
+    change anything become no-ops. Later operations override earlier ones, so wip followed by ready is a single
+    ready request carrying messages of both, and hashtags from several commands are set with one request. Topic,
+    hashtags and private state have no place in a review input, so they keep their own endpoints. Fused operations
+    do not hold the state anymore, so that plans of many changes do not keep their ChangeInfos in memory.
+    """
+    for _, group in groupby(operations, key=lambda operation: operation.change):
+        for operation in _fuse_change(list(group)):
+            yield operation._replace(state=None)
+
+
+def _fuse_change(operations):
+    state = operations[0].state or {}
+    closed = f"change is {state['status'].lower()}" if state.get("status") in ("MERGED", "ABANDONED") else None
+    adds, removes = {}, {}
+    wanted = {}  # ChangeInfo field: (wanted value, last operation, messages)
+    last = {}
+    for operation in operations:
+        if operation.noop:
+            yield operation
+        elif operation.action == "hashtags":
+            # dicts as ordered sets, tag added after being removed is added and vice versa
+            for tag in operation.payload.get("add", []):
+                removes.pop(tag, None)
+                adds[tag] = None
+            for tag in operation.payload.get("remove", []):
+                adds.pop(tag, None)
+                removes[tag] = None
+        elif operation.action in STATE_FIELDS:
+            field, value = STATE_FIELDS[operation.action]
+            messages = wanted.get(field, (None, None, []))[2]
+            if operation.payload:
+                messages.append(operation.payload["message"])
+            wanted[field] = (value, operation, messages)
+        else:
+            last[operation.action] = operation
+
+    if adds or removes:
+        current = state.get("hashtags")
+        add = [tag for tag in adds if current is None or tag not in current]
+        remove = [tag for tag in removes if current is None or tag in current]
+        payload = {key: tags for key, tags in (("remove", remove), ("add", add)) if tags}
+        if not payload:
+            payload = {"add": list(adds), "remove": list(removes)}
+            noop = "hashtags already up to date"
+        else:
+            noop = None
+        yield operations[0]._replace(action="hashtags", payload=payload, noop=noop)
+
+    for field, (value, operation, messages) in wanted.items():
+        noop = closed or (NOOP_REASONS[operation.action] if bool(state.get(field)) == value else None)
+        yield operation._replace(payload=_message_payload("\n\n".join(messages)), noop=noop)
+
+    if "topic" in last:
+        topic = last["topic"]
+        yield topic._replace(noop="topic already set" if state.get("topic", "") == topic.payload["topic"] else None)
+    if "abandon" in last:
+        yield last["abandon"]._replace(noop=closed)
+
+
+def perform(rest, operation):
+    """Sends the request of the operation, conflicts mean the change is already in requested state"""
+    try:
+        return getattr(rest, operation.method.lower())(operation.endpoint, data=operation.payload)
+    except requests.exceptions.HTTPError as e:
+        LOGGER.debug(f"HTTP Error Occured: {str(e)}")
+        if e.response.status_code != 409:
+            raise http_error(e, operation.name)
+
+
+def print_plan(rest, operations, reads_before=0, journal=None, output=None):
+    """Prints the plan and estimated cost of executing it"""
+    output = output or Output()
+    requests_to_send = noops = upload = 0
+    LOGGER.info("Plan:")
+    for operation in operations:
+        noop = operation.noop or (JOURNALED if journal and journal.done(operation) else None)
+        output.emit("operation", operation.record(noop, "planned"), f" * {operation.describe(noop)}")
+        if noop:
+            noops += 1
+        else:
+            requests_to_send += 1
+            upload += REQUEST_OVERHEAD_BYTES + len(operation.endpoint) + len(operation.body())
+    LOGGER.info(
+        f"{requests_to_send} request(s) to send, ~{upload / 1024:.1f} KiB to upload, {noops} no-op(s) skipped."
+        f" Planning took {rest.requests_sent - reads_before} read request(s)."
+    )
+
+
+def execute_plan(rest, operations, journal=None, output=None):
+    """Executes every operation of the plan that is not a no-op or already completed according to journal.
+    Operation is output once its request has completed"""
+    output = output or Output()
+    with Progress(rest, len(operations), "operations") as progress:
+        for operation in operations:
+            noop = operation.noop or (JOURNALED if journal and journal.done(operation) else None)
+            if not noop:
+                perform(rest, operation)
+                if journal:
+                    journal.record(operation)
+            output.emit("operation", operation.record(noop), f" * {operation.describe(noop)}")
+            progress.advance()
+
+
+def run_plan(rest, args, operations):
+    """Prints the plan with --dry-run, executes it otherwise. Executed operations are journaled for --resume
+
+    When args has pending_operations (batch --fuse), operations are only collected there to be fused with the ones
+    of following commands.
+
+    The whole plan is built before the first request is sent, which also reads every page of --query results
+    before any change is modified. Paging by offset would skip changes that the plan moves between pages, so
+    memory held by the plan grows with the number of changes, one fused Operation per request.
+    """
+    if getattr(args, "pending_operations", None) is not None:
+        args.pending_operations.extend(operations)
+        return
+    operations = list(fuse(operations))
+    journal = None
+    git_dir = args.git_repo.git_dir if getattr(args, "git_repo", None) else None
+    if git_dir:
+        journal = Journal(git_dir, journal_name(args.cmd.__name__, args.target_options), args.resume)
+    output = getattr(args, "output", None)
+    if args.dry_run:
+        print_plan(rest, operations, getattr(args, "requests_before", rest.requests_sent), journal, output)
+        return
+
+    completed = False
+    try:
+        execute_plan(rest, operations, journal, output)
+        completed = True
+    finally:
+        if journal:
+            journal.close(completed)
@@ -0,0 +1,76 @@
+"""Progress of bulk operations.
+
+Shows completed/total (or just completed while the total is not known, like with query results that are still
+being fetched), request rate, p95 latency of the latest requests and estimated time left in a status line
+below the log, so slow servers are noticed right away. Status line is redrawn at most every PROGRESS_INTERVAL
+seconds and only when logging into a terminal, otherwise advancing costs a single comparison. When progress is
+already shown, like the progress of repositories with --repos, progress of their commands is not.
+"""
+import threading
+import time
+from .logger import status_line_enabled, set_status_line
+
+PROGRESS_INTERVAL = 0.25
+_ACTIVE = []
+_ACTIVE_LOCK = threading.Lock()
+
+
+class Progress:
+    """Progress of total items, None if not known, done with requests of rest client. Use as context manager or
+    close() when done"""
+
+    def __init__(self, rest, total, label="changes"):
+        self.rest = rest
+        self.total = total
+        self.label = label
+        self.completed = 0
+        self.enabled = (total is None or total > 1) and status_line_enabled()
+        if self.enabled:
+            with _ACTIVE_LOCK:
+                self.enabled = not _ACTIVE
+                if self.enabled:
+                    _ACTIVE.append(self)
+        self._started = self._drawn = time.monotonic()
+        self._requests_before = rest.requests_sent
+        self._shown = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def advance(self, count=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.completed += count
+            now = time.monotonic()
+            if now - self._drawn < PROGRESS_INTERVAL:
+                return
+            self._drawn = now
+            set_status_line(self.describe(now))
+            self._shown = True
+
+    def describe(self, now=None):
+        elapsed = (now or time.monotonic()) - self._started
+        rate = (self.rest.requests_sent - self._requests_before) / elapsed if elapsed else 0
+        done = self.completed if self.total is None else f"{self.completed}/{self.total}"
+        description = f"{done} {self.label}, {rate:.1f} req/s"
+        latencies = sorted(self.rest.latencies)
+        if latencies:
+            description += f", p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.0f}ms"
+        if self.completed and self.total is not None:
+            description += f", ETA {elapsed / self.completed * (self.total - self.completed):.0f}s"
+        return description
+
+    def close(self):
+        with self._lock:
+            if self._shown:
+                set_status_line("")
+                self._shown = False
+            if self.enabled:
+                self.enabled = False
+                with _ACTIVE_LOCK:
+                    _ACTIVE.remove(self)
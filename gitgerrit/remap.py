@@ -0,0 +1,111 @@
+"""Moving review comments from the revision that was analysed to a newer one.
+
+Hunks of a single `git diff -U0` between the revisions are indexed per file as sorted arrays of the old line ranges
+they replace and the cumulative line shift after each of them. Every comment line is then remapped with a binary
+search, so remapping is O(log hunks) per comment. Comments on lines that were deleted or rewritten, or on files
+that were deleted (renames are not followed), are dropped.
+"""
+import codecs
+import re
+import subprocess
+from bisect import bisect_right
+from .logger import LOGGER
+
+RE_HUNK = re.compile(r"^@@ -(?P<start>\d+)(?:,(?P<count>\d+))? \+\d+(?:,(?P<new_count>\d+))? @@")
+# Above this, whole trees are diffed instead of passing the paths on command line
+MAX_PATHSPECS = 1000
+
+
+class HunkIndex:
+    """Line mapping of one file. starts and ends are sorted old line ranges [start, end) replaced by hunks and
+    shifts[i] is how much lines after the first i hunks have moved"""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.shifts = [0]
+
+    def add(self, start, count, new_count):
+        # pure insertion (count 0) comes after line start, so it does not replace any line
+        start = start if count else start + 1
+        self.starts.append(start)
+        self.ends.append(start + count)
+        self.shifts.append(self.shifts[-1] + new_count - count)
+
+    def map(self, line):
+        """Line number in the new revision, None if the line was deleted or rewritten"""
+        hunk = bisect_right(self.starts, line) - 1
+        if hunk >= 0 and line < self.ends[hunk]:
+            return None
+        return line + self.shifts[bisect_right(self.ends, line)]
+
+
+def unquote_path(name):
+    """Name from diff header, git quotes names with control characters, quotes or backslashes C style"""
+    if not name.startswith('"'):
+        return name
+    return codecs.escape_decode(name[1:-1].encode("utf-8"))[0].decode("utf-8", "replace")
+
+
+def diff_index(working_tree, base, target, paths):
+    """Returns {path: HunkIndex} of files changed between base and target, deleted files map to None"""
+    # prefixes and quoting of paths are fixed, whatever diff.noPrefix, diff.mnemonicPrefix or core.quotePath say
+    command = ["git", "-c", "core.quotePath=false", "diff", "-U0", "--no-renames", "--no-color", "--no-ext-diff"]
+    command += ["--src-prefix=a/", "--dst-prefix=b/", base, target, "--"]
+    if len(paths) <= MAX_PATHSPECS:
+        command += list(paths)
+    process = subprocess.run(command, cwd=working_tree, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError(f"Diffing {base} to {target} failed: {process.stderr.decode('utf-8', 'replace').strip()}")
+
+    files = {}
+    old_path = index = None
+    for line in process.stdout.decode("utf-8", "replace").splitlines():
+        if line.startswith("@@"):
+            match = RE_HUNK.match(line)
+            if match and index is not None:
+                count, new_count = (1 if value is None else int(value) for value in match.group("count", "new_count"))
+                index.add(int(match.group("start")), count, new_count)
+        elif line.startswith("--- "):
+            # git appends a tab to names with spaces, added files have no old name
+            old_path = line[4:].rstrip("\t")
+            old_path = None if old_path == "/dev/null" else unquote_path(old_path)[2:]
+            index = None
+        elif line.startswith("+++ ") and old_path is not None:
+            index = None if line[4:].rstrip("\t") == "/dev/null" else HunkIndex()
+            files[old_path] = index
+    return files
+
+
+def _remap_comment(comment, index):
+    if comment.range:
+        start = index.map(comment.range[0])
+        end = index.map(comment.range[2])
+        if start is None or end is None:
+            return None
+        return comment.moved(end if comment.line is not None else None, (start, comment.range[1], end, comment.range[3]))
+    if comment.line:
+        line = index.map(comment.line)
+        return comment.moved(line, None) if line is not None else None
+    return comment
+
+
+def remap_comments(working_tree, base, target, comments):
+    """Returns RobotComments ({path: [comment]}) with lines of base revision moved to target revision"""
+    files = diff_index(working_tree, base, target, comments)
+    remapped = {}
+    dropped = 0
+    for path, path_comments in comments.items():
+        if path not in files:
+            remapped[path] = path_comments  # unchanged file
+            continue
+        index = files[path]
+        kept = []
+        if index is not None:
+            kept = [comment for comment in (_remap_comment(comment, index) for comment in path_comments) if comment]
+        dropped += len(path_comments) - len(kept)
+        if kept:
+            remapped[path] = kept
+    if dropped:
+        LOGGER.warning(f"{dropped} comment(s) dropped, their lines were deleted or rewritten after {base}")
+    return remapped
@@ -0,0 +1,112 @@
+"""Lazy access to the git repository.
+
+Many invocations (--changeid, --query, configuration from environment) never need the repository at all, so
+GitPython is imported and git.Repo created only when a command really uses it. Locating the repository is a plain
+filesystem walk looking for .git, and found repositories are cached for the lifetime of the process.
+"""
+import glob
+from pathlib import Path
+from xml.etree import ElementTree
+
+MAX_INCLUDE_DEPTH = 10
+_FOUND = {}
+
+
+def find_repository(start):
+    """Returns (working tree, git directory) of the repository containing start, None when there is none"""
+    if start not in _FOUND:
+        found = _walk(Path(start).absolute())
+        if not found:
+            return None  # not cached, repository may still be created while a daemon is running
+        _FOUND[start] = found
+    return _FOUND[start]
+
+
+def _walk(start):
+    for directory in (start,) + tuple(start.parents):
+        dot_git = directory / ".git"
+        if dot_git.is_dir():
+            return str(directory), str(dot_git)
+        if dot_git.is_file():
+            # linked worktrees and submodules have a file pointing to their git directory
+            content = dot_git.read_text().strip()
+            if content.startswith("gitdir:"):
+                return str(directory), str((directory / content[len("gitdir:") :].strip()).resolve())
+    return None
+
+
+class LazyRepo:
+    """Stands in for git.Repo of the first repository found from given start directories.
+
+    git_dir is available without creating git.Repo and is None outside of a repository. Any other attribute is
+    looked up from git.Repo, which is created on first access and raises RuntimeError outside of a repository.
+    """
+
+    def __init__(self, starts):
+        self._starts = starts
+        self._repo = None
+
+    def _find(self):
+        for start in self._starts:
+            found = find_repository(str(start))
+            if found:
+                return found
+        return None
+
+    @property
+    def git_dir(self):
+        found = self._find()
+        return found[1] if found else None
+
+    @property
+    def working_tree_dir(self):
+        found = self._find()
+        return found[0] if found else None
+
+    @property
+    def repo(self):
+        if self._repo is None:
+            found = self._find()
+            if not found:
+                raise RuntimeError(f"No git repository found from {', '.join(str(start) for start in self._starts)}")
+            import git
+
+            self._repo = git.Repo(found[0])
+        return self._repo
+
+    def __getattr__(self, name):
+        return getattr(self.repo, name)
+
+
+def find_repositories(spec):
+    """Returns working tree directories listed in repo tool manifest (.xml file) or matching glob pattern"""
+    manifest = Path(spec)
+    if manifest.suffix == ".xml" and manifest.is_file():
+        return manifest_repositories(manifest)
+    return sorted(path for path in glob.glob(spec) if (Path(path) / ".git").exists())
+
+
+def manifest_repositories(manifest):
+    """Working tree directories of the projects in repo tool manifest, includes and removed projects respected"""
+    manifest = Path(manifest).resolve()
+    repo_dir = next((parent for parent in manifest.parents if parent.name == ".repo"), None)
+    # manifests of a repo checkout include each other from .repo/manifests and project paths start from the top
+    top = repo_dir.parent if repo_dir else manifest.parent
+    include_dir = repo_dir / "manifests" if repo_dir else manifest.parent
+    projects = []
+    _read_manifest(manifest, include_dir, projects)
+    return [str(top / path) for _, path in projects]
+
+
+def _read_manifest(manifest, include_dir, projects, depth=0):
+    try:
+        root = ElementTree.parse(str(manifest)).getroot()
+    except (OSError, ElementTree.ParseError) as error:
+        raise RuntimeError(f"Reading manifest {manifest} failed: {error}")
+    for element in root:
+        if element.tag == "include" and depth < MAX_INCLUDE_DEPTH:
+            _read_manifest(include_dir / element.get("name"), include_dir, projects, depth + 1)
+        elif element.tag == "project":
+            projects.append((element.get("name"), element.get("path") or element.get("name")))
+        elif element.tag == "remove-project":
+            projects[:] = [project for project in projects if project[0] != element.get("name")]
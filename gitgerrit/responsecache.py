@@ -0,0 +1,158 @@
+"""Gerrit responses shared between processes.
+
+Parallel ci jobs on the same machine tend to read the very same change details, chains and comments. When
+gerrit.sharedCache is configured, GET responses are kept in a SQLite database in WAL mode, so that any number of
+processes can read it while one of them writes. Responses are kept per user, as what gerrit returns depends on what
+the user can see. Every endpoint has its own time to live, writing to a change drops everything cached about it and
+about several changes at once (queries, chains) for all users, and the database is trimmed back under
+MAX_CACHE_BYTES every now and then. Cache is an optimization only, any database error is treated as a miss.
+"""
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+from . import codec
+from .changeids import cache_dir
+from .client import RE_MULTI_CHANGE_ENDPOINT
+from .logger import LOGGER
+
+# (endpoint pattern, seconds to keep response), first match wins
+ENDPOINT_TTLS = [
+    (re.compile(r"^/?changes/\?"), 30),  # queries see any change
+    (RE_MULTI_CHANGE_ENDPOINT, 60),
+    (re.compile(r"/revisions/[0-9a-f]{40}/"), 300),  # exact patch set
+]
+DEFAULT_TTL = 60
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+# Expired and oldest entries are deleted after every this many stored responses
+EVICT_EVERY = 100
+BUSY_TIMEOUT_MS = 2000
+# Databases of other schema versions are emptied and recreated
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    host TEXT NOT NULL,
+    user TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    change TEXT,
+    expires REAL NOT NULL,
+    size INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    PRIMARY KEY (host, user, endpoint)
+);
+CREATE INDEX IF NOT EXISTS responses_change ON responses (host, change);
+CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires);
+"""
+
+
+def ttl_of(endpoint):
+    for pattern, ttl in ENDPOINT_TTLS:
+        if pattern.search(endpoint):
+            return ttl
+    return DEFAULT_TTL
+
+
+class ResponseCache:
+    """Thread safe, multi-process cache of decoded GET responses of one user of a gerrit host. hits and misses count
+    lookups"""
+
+    def __init__(self, path, host, user):
+        self.path = Path(path)
+        self.host = host
+        self.user = user
+        self.hits = 0
+        self.misses = 0
+        self._stored = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._disabled = False
+
+    @classmethod
+    def from_config(cls, value, host, user):
+        """Cache configured with gerrit.sharedCache: path to the database or true for the default location"""
+        if not value or value.lower() in ("false", "no", "off", "0"):
+            return None
+        if value.lower() in ("true", "yes", "on", "1"):
+            return cls(cache_dir() / f"{quote(host, safe='')}.responses.sqlite", host, user)
+        return cls(Path(value).expanduser(), host, user)
+
+    def _connection(self):
+        # sqlite connections cannot be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            if connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                connection.executescript(
+                    f"BEGIN IMMEDIATE; DROP TABLE IF EXISTS responses; {SCHEMA} PRAGMA user_version = {SCHEMA_VERSION}; COMMIT;"
+                )
+            self._local.connection = connection
+        return connection
+
+    def _run(self, operation):
+        if self._disabled:
+            return None
+        try:
+            return operation(self._connection())
+        except (sqlite3.Error, OSError) as error:
+            LOGGER.debug(f"Shared cache {self.path} disabled: {error}")
+            self._disabled = True
+            return None
+
+    def get(self, endpoint):
+        """Returns decoded response or None"""
+        row = self._run(
+            lambda db: db.execute(
+                "SELECT body FROM responses WHERE host = ? AND user = ? AND endpoint = ? AND expires > ?",
+                (self.host, self.user, endpoint, time.time()),
+            ).fetchone()
+        )
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return codec.loads(row[0])
+
+    def put(self, endpoint, change, decoded):
+        """Stores decoded response of endpoint. change is the change response is about, None when it is about several"""
+        body = codec.dumps(decoded)
+        self._run(
+            lambda db: db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.host, self.user, endpoint, change, time.time() + ttl_of(endpoint), len(body), body),
+            )
+        )
+        with self._lock:
+            self._stored += 1
+            evict = self._stored % EVICT_EVERY == 0
+        if evict:
+            self._run(self._evict)
+
+    def invalidate(self, changes):
+        """Drops responses of all users about given changes (all aliases of one change) and about several changes"""
+        changes = [change for change in changes if change]
+        placeholders = ", ".join("?" for _ in changes) or "NULL"
+        self._run(
+            lambda db: db.execute(
+                f"DELETE FROM responses WHERE host = ? AND (change IS NULL OR change IN ({placeholders}))", [self.host] + changes
+            )
+        )
+
+    def _evict(self, db):
+        db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+        total = db.execute("SELECT total(size) FROM responses").fetchone()[0]
+        if total > MAX_CACHE_BYTES:
+            # entries expiring first are the oldest ones, delete them until the cache is at 3/4 of its limit
+            excess = total - MAX_CACHE_BYTES * 3 // 4
+            rowids = []
+            for rowid, size in db.execute("SELECT rowid, size FROM responses ORDER BY expires"):
+                if excess <= 0:
+                    break
+                rowids.append((rowid,))
+                excess -= size
+            db.executemany("DELETE FROM responses WHERE rowid = ?", rowids)
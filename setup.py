@@ -44,6 +44,7 @@ setup(
     license="Apache License 2.0",
     classifiers=CLASSIFIERS,
     install_requires=REQUIREMENTS,
+    extras_require={"fast": ["orjson"]},
     keywords="git gerrit ci",
     platforms="any",
     entry_points={"console_scripts": ["git-gerrit=gitgerrit:main"], },